@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.gen_ap import COST_MODELS, gen_ap_order, gen_ap_order_lazy, load_stats
+
+
+# Benchmark of source ordering over the URs of the AP corpus:
+# eager greedy (gen_ap_order) vs lazy greedy (gen_ap_order_lazy) with each cost model.
+def _time_orders(fn, urs, repeat):
+    best = float("inf")
+    orders = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        orders = [fn(ur) for ur in urs]
+        best = min(best, time.perf_counter() - t0)
+    return orders, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gen_ap_order vs gen_ap_order_lazy.")
+    parser.add_argument("--split", default=os.path.join(PROJECT_ROOT, "data", "MATHE_random_100"))
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_ROOT, "data", "generated_aps", "ap_corpus", "ap_corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    stats = load_stats(args.split)
+    with open(args.corpus) as f:
+        urs = [json.loads(line)["ur"] for line in f if line.strip()]
+
+    ref, t_ref = _time_orders(lambda ur: gen_ap_order(ur, stats), urs, args.repeat)
+    print(f"URs: {len(urs)}  sources: {stats['postings'].n_sources}  (best of {args.repeat})")
+    print(f"{'variant':<22}{'total ms':>10}{'us/UR':>10}{'sources':>9}{'rows':>9}{'bytes':>12}  same order")
+
+    def report(name, orders, secs):
+        rows = stats.get("source_rows")
+        nbytes = stats.get("source_bytes")
+        n_src = sum(len(o) for o in orders)
+        tot_rows = sum(int(rows[s]) for o in orders for s in o) if rows is not None else "-"
+        tot_bytes = sum(int(nbytes[s]) for o in orders for s in o) if nbytes is not None else "-"
+        print(f"{name:<22}{secs * 1e3:>10.2f}{secs / len(urs) * 1e6:>10.1f}{n_src:>9}{tot_rows:>9}{tot_bytes:>12}  {orders == ref}")
+
+    report("greedy", ref, t_ref)
+    for name in COST_MODELS:
+        try:
+            orders, secs = _time_orders(lambda ur: gen_ap_order_lazy(ur, stats, cost_model=name), urs, args.repeat)
+        except ValueError as e:
+            print(f"lazy[{name}]: skipped ({e})")
+            continue
+        report(f"lazy[{name}]", orders, secs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.nl_to_ur import CompiledLexicon, _norm, expand_synonyms, load_compiled_lexicon, parse_nl_to_ur
+
+
+# The per-phrase scan parse_nl_to_ur used before LexiconMatcher (topic/subtopic/keyword part only),
+# kept here as the reference for correctness and speed.
+def _scan_match(text, lexicon):
+    t_tokens = set(expand_synonyms(_norm(text)).split())
+    ur = {}
+    for attr in ["topic_name", "subtopic_name", "keyword_name"]:
+        matched = []
+        for p in lexicon.get(attr, []):
+            p_exp = expand_synonyms(_norm(p))
+            if set(p_exp.split()).issubset(t_tokens):
+                matched.append(p)
+        if matched:
+            ur[attr] = list(dict.fromkeys(matched))
+    return ur
+
+
+def _qps(fn, queries, min_secs):
+    n = 0
+    t0 = time.perf_counter()
+    while True:
+        for q in queries:
+            fn(q)
+        n += len(queries)
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_secs:
+            return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NL -> UR parsing throughput over the AP corpus NL strings.")
+    parser.add_argument("--lexicon", default=os.path.join(PROJECT_ROOT, "demo", "lexicon.json"))
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_ROOT, "data", "generated_aps", "ap_corpus", "ap_corpus.jsonl"))
+    parser.add_argument("--secs", type=float, default=2.0, help="minimum measuring time per variant")
+    args = parser.parse_args()
+
+    with open(args.lexicon) as f:
+        lexicon = json.load(f)
+    with open(args.corpus) as f:
+        queries = [json.loads(line)["nl"] for line in f if line.strip()]
+
+    t0 = time.perf_counter()
+    matcher = CompiledLexicon(lexicon)
+    build_ms = (time.perf_counter() - t0) * 1e3
+    load_compiled_lexicon(args.lexicon)  # make sure the artifact exists
+    t0 = time.perf_counter()
+    load_compiled_lexicon(args.lexicon)
+    load_ms = (time.perf_counter() - t0) * 1e3
+
+    attrs = CompiledLexicon.ATTRS
+    same = all(
+        {a: v for a, v in parse_nl_to_ur(q, matcher).items() if a in attrs} == _scan_match(q, lexicon)
+        for q in queries
+    )
+
+    print(f"queries: {len(queries)}  same UR as scan: {same}")
+    print(f"compile from lexicon.json: {build_ms:.1f} ms  load from artifact: {load_ms:.1f} ms")
+    print(f"{'variant':<34}{'queries/sec':>12}")
+    print(f"{'scan (phrase match only)':<34}{_qps(lambda q: _scan_match(q, lexicon), queries, args.secs):>12.0f}")
+    print(f"{'parse_nl_to_ur subset':<34}{_qps(lambda q: parse_nl_to_ur(q, matcher), queries, args.secs):>12.0f}")
+    print(f"{'parse_nl_to_ur contiguous':<34}{_qps(lambda q: parse_nl_to_ur(q, matcher, mode='contiguous'), queries, args.secs):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
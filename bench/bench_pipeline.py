@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.execute_ap import execute_ap, ingest_split
+from demo.gen_ap import build_sql_plan, compile_ur, gen_ap_order, load_stats
+from demo.generate_stats import generate_stats_from_folder
+from demo.nl_to_ur import load_compiled_lexicon
+from demo.utils import EPrune
+
+STAGES = ["parse", "order", "plan", "execute", "prune"]
+
+
+# End-to-end benchmark: replays the AP corpus through NL -> UR -> order -> SQL plan -> execute -> EPrune.
+# Stages run one after the other over the whole workload (stage-major), so the RSS high-water mark
+# measured after each stage tells which stage made the process grow.
+# The corpus URs (not the parsed ones) feed the planning stages, so every split sees the same workload.
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # bytes on macOS, KiB on Linux
+
+
+def _summary(latencies):
+    lat = np.asarray(latencies, dtype=np.float64)
+    total = float(lat.sum())
+    return {
+        "n": len(lat),
+        "p50_ms": float(np.percentile(lat, 50) * 1e3),
+        "p95_ms": float(np.percentile(lat, 95) * 1e3),
+        "p99_ms": float(np.percentile(lat, 99) * 1e3),
+        "mean_ms": float(lat.mean() * 1e3),
+        "total_s": total,
+        "qps": len(lat) / total if total > 0 else float("inf"),
+    }
+
+
+def _timed(fn, items):
+    out, lat = [], []
+    for item in items:
+        t0 = time.perf_counter()
+        out.append(fn(item))
+        lat.append(time.perf_counter() - t0)
+    return out, lat
+
+
+def _compile_and_order(ur, stats):
+    cur = compile_ur(ur, stats)
+    return cur, gen_ap_order(cur, stats)
+
+
+def run_pipeline(split_path, queries, lexicon_path, repeat=1, use_db=True, stages=STAGES):
+    results = {"setup": {}, "stages": {}}
+
+    def once(name, fn):
+        t0 = time.perf_counter()
+        value = fn()
+        results["setup"][name] = {"s": time.perf_counter() - t0, "peak_rss_mb": _peak_rss_mb()}
+        return value
+
+    lexicon = once("load_lexicon", lambda: load_compiled_lexicon(lexicon_path))
+    stats = once("load_stats", lambda: load_stats(split_path))
+    if "execute" in stages and use_db:
+        once("ingest", lambda: ingest_split(split_path))
+
+    nls = [q["nl"] for q in queries] * repeat
+    urs = [q["ur"] for q in queries] * repeat
+    source_files = stats.get("source_files")
+
+    def stage(name, fn, items):
+        rss0 = _peak_rss_mb()
+        out, lat = _timed(fn, items)
+        rss1 = _peak_rss_mb()
+        results["stages"][name] = {**_summary(lat), "peak_rss_mb": rss1, "rss_growth_mb": rss1 - rss0}
+        return out
+
+    # stages left out of the run still compute their output (untimed) when a later stage needs it
+    def run(name, fn, items):
+        if name in stages:
+            return stage(name, fn, items)
+        return [fn(item) for item in items]
+
+    if "parse" in stages:
+        stage("parse", lambda nl: lexicon.parse(nl), nls)
+
+    # compile_ur (the value-index lookups) counts as part of "order"
+    ordered = run("order", lambda ur: _compile_and_order(ur, stats), urs)
+    plans = run("plan", lambda co: build_sql_plan(co[0], co[1], stats), ordered)
+
+    if "execute" in stages or "prune" in stages:
+        frames = run("execute", lambda plan: execute_ap(plan, split_path, source_files=source_files, use_db=use_db), plans)
+        if "prune" in stages:
+            pruned = stage("prune", lambda i: EPrune(frames[i], urs[i]), range(len(urs)))
+            results["rows"] = {
+                "executed": int(sum(len(df) for df in frames)),
+                "pruned": int(sum(len(df) for df in pruned)),
+            }
+
+    results["sources_scanned"] = int(sum(len(p) for p in plans))
+    return results
+
+
+# ---- synthetic scaler ----
+# Derive an n_sources split from a base split: source k is a seeded random sample
+# (50-100% of the rows) of base source k % n_base, so value frequencies and postings grow
+# like a bigger MATHE would. Stats are built with the parallel builder.
+def make_synthetic_split(base_split, out_dir, n_sources, seed=0, workers=1):
+    if os.path.exists(os.path.join(out_dir, "stats.npz")):
+        return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    base_files = sorted(f for f in os.listdir(base_split) if f.endswith(".csv"))
+    base = [pd.read_csv(os.path.join(base_split, f), low_memory=False) for f in base_files]
+    rng = np.random.default_rng(seed)
+    width = len(str(n_sources))
+    for k in range(n_sources):
+        df = base[k % len(base)]
+        frac = rng.uniform(0.5, 1.0)
+        sample = df.sample(frac=frac, random_state=int(rng.integers(2**31)))
+        sample.to_csv(os.path.join(out_dir, f"src_{k + 1:0{width}d}.csv"), index=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate_stats_from_folder(out_dir, workers=workers)
+    return out_dir
+
+
+def _print_table(results):
+    print(f"{'stage':<10}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/s':>10}{'peak RSS MB':>13}")
+    for name, r in results["stages"].items():
+        print(f"{name:<10}{r['n']:>6}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['qps']:>10.1f}{r['peak_rss_mb']:>13.1f}")
+    for name, r in results["setup"].items():
+        print(f"{name:<14}{r['s'] * 1e3:>10.1f} ms")
+
+
+# Ratio of this run's p50/p95 to a previous JSON result, per stage (> 1 = slower).
+def _compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        base = json.load(f)
+    regressions = []
+    print(f"\nvs {baseline_path}")
+    for name, r in results["stages"].items():
+        b = base.get("stages", {}).get(name)
+        if not b:
+            continue
+        ratios = {k: r[k] / b[k] if b[k] else float("inf") for k in ("p50_ms", "p95_ms")}
+        flag = " REGRESSION" if max(ratios.values()) > threshold else ""
+        print(f"{name:<10} p50 x{ratios['p50_ms']:.2f}  p95 x{ratios['p95_ms']:.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage latency / throughput / RSS of the AP pipeline over the AP corpus.")
+    parser.add_argument("--split", default=os.path.join(PROJECT_ROOT, "data", "MATHE_random_100"))
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_ROOT, "data", "generated_aps", "ap_corpus", "ap_corpus.jsonl"))
+    parser.add_argument("--lexicon", default=os.path.join(PROJECT_ROOT, "demo", "lexicon.json"))
+    parser.add_argument("--repeat", type=int, default=1, help="replay the corpus N times")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated subset of " + ",".join(STAGES))
+    parser.add_argument("--no-db", action="store_true", help="execute against the CSVs instead of split.duckdb")
+    parser.add_argument("--synthetic", type=int, default=None, metavar="N",
+                        help="benchmark a derived N-source split (created once under --synthetic-dir)")
+    parser.add_argument("--synthetic-dir", default=os.path.join(PROJECT_ROOT, "data", "synthetic"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="stats build workers for --synthetic")
+    parser.add_argument("--out", default=None, help="write the results as JSON")
+    parser.add_argument("--compare", default=None, help="previous JSON result to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages: {unknown!r}")
+
+    split_path = args.split
+    if args.synthetic:
+        name = f"{os.path.basename(os.path.normpath(args.split))}_x{args.synthetic}"
+        t0 = time.perf_counter()
+        split_path = make_synthetic_split(args.split, os.path.join(args.synthetic_dir, name), args.synthetic, workers=args.workers)
+        print(f"synthetic split: {split_path} ({time.perf_counter() - t0:.1f}s)")
+
+    with open(args.corpus) as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+
+    results = run_pipeline(split_path, queries, args.lexicon, repeat=args.repeat, use_db=not args.no_db, stages=stages)
+    results["meta"] = {
+        "split": split_path,
+        "corpus": args.corpus,
+        "queries": len(queries),
+        "repeat": args.repeat,
+        "use_db": not args.no_db,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": int(time.time()),
+    }
+
+    _print_table(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        if _compare(results, args.compare, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
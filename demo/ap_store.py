@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.cache import canonical_ur
+from demo.value_encoding import canon_value
+
+# Local stand-ins for the Neo4j /storeAP backend.
+# An AP record is the object build_storeap_payload serializes:
+#   {"nl", "ur", "source_order", "sql_plan", "meta"}
+# Each stored record gets an "id" (and meta.timestamp if missing). ap_corpus.jsonl lines
+# ({"nl", "ur", "ap": {...}}) are accepted too.
+
+
+# Append-only JSON lines file: one stored AP per line, loaded into memory on open.
+class JsonlAPStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._aps = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        ap = json.loads(line)
+                        self._aps[ap["id"]] = ap
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __len__(self):
+        return len(self._aps)
+
+    def close(self):
+        pass
+
+    # ap: an AP dict, or the {"ap": "<json string>"} payload of build_storeap_payload
+    def store(self, ap):
+        ap = _as_ap(ap)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(ap) + "\n")
+            self._aps[ap["id"]] = ap
+        return ap["id"]
+
+    def get(self, ap_id):
+        return self._aps.get(ap_id)
+
+    def all(self):
+        return list(self._aps.values())
+
+
+def _as_ap(ap):
+    if isinstance(ap, dict) and isinstance(ap.get("ap"), str):
+        ap = json.loads(ap["ap"])
+    elif isinstance(ap, dict) and isinstance(ap.get("ap"), dict):  # ap_corpus.jsonl line
+        ap = {**{k: v for k, v in ap.items() if k != "ap"}, **ap["ap"]}
+    ap = dict(ap)
+    ap.setdefault("id", uuid.uuid4().hex)
+    meta = dict(ap.get("meta") or {})
+    meta.setdefault("timestamp", int(time.time()))
+    ap["meta"] = meta
+    return ap
+
+
+# (column, canonical value) pairs of a UR, deduplicated, in column order
+def _ur_items(UR):
+    items = set()
+    for col, values in (UR or {}).items():
+        for v in values:
+            cv = canon_value(v)
+            if cv is not None:
+                items.add((col, cv))
+    return sorted(items)
+
+
+# Tables an AP reads, in plan order (source_order when there is no plan)
+def _ap_sources(ap):
+    tables = [step["table"] for step in ap.get("sql_plan") or [] if step.get("table")]
+    return list(dict.fromkeys(tables or ap.get("source_order") or []))
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS aps (
+    id TEXT PRIMARY KEY,
+    nl TEXT,
+    ur_key TEXT NOT NULL,
+    n_items INTEGER NOT NULL,
+    dataset TEXT,
+    split TEXT,
+    timestamp INTEGER,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ur_items (
+    ap_id TEXT NOT NULL REFERENCES aps(id) ON DELETE CASCADE,
+    col TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (ap_id, col, value)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ap_sources (
+    ap_id TEXT NOT NULL REFERENCES aps(id) ON DELETE CASCADE,
+    source TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (ap_id, source)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ur_items_value ON ur_items (col, value, ap_id);
+CREATE INDEX IF NOT EXISTS ap_sources_source ON ap_sources (source, ap_id);
+CREATE INDEX IF NOT EXISTS aps_timestamp ON aps (timestamp);
+CREATE INDEX IF NOT EXISTS aps_ur_key ON aps (split, ur_key);
+"""
+
+
+# SQLite-backed store, indexed for lookups without scanning the records:
+#   ur_items   (col, canonical value) -> AP ids   by_value(), find_covering()
+#   ap_sources source table -> AP ids            by_source()
+#   aps        timestamp, (split, canonical UR)  recent(), find_exact()
+# The full AP is kept as JSON in aps.record. UR values are canonicalized like the value
+# index (80 == 80.0 == "80"). Same store / get / all / len interface as JsonlAPStore.
+class SQLiteAPStore:
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self._con.execute("PRAGMA journal_mode = WAL")
+            self._con.execute("PRAGMA synchronous = NORMAL")
+        self._con.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute("SELECT COUNT(*) FROM aps").fetchone()[0]
+
+    def store(self, ap):
+        return self.store_many([ap])[0]
+
+    # Bulk insert in one transaction; an AP whose id is already stored is replaced.
+    def store_many(self, aps):
+        aps_rows, item_rows, source_rows, ids = [], [], [], []
+        for ap in aps:
+            ap = _as_ap(ap)
+            items = _ur_items(ap.get("ur"))
+            meta = ap["meta"]
+            aps_rows.append((
+                ap["id"], ap.get("nl"), canonical_ur(ap.get("ur") or {}), len(items),
+                meta.get("dataset"), meta.get("split"), meta.get("timestamp"), json.dumps(ap),
+            ))
+            item_rows.extend((ap["id"], col, v) for col, v in items)
+            source_rows.extend((ap["id"], src, i) for i, src in enumerate(_ap_sources(ap)))
+            ids.append(ap["id"])
+        with self._lock, self._con:
+            self._con.executemany("INSERT OR REPLACE INTO aps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", aps_rows)
+            self._con.executemany("INSERT OR IGNORE INTO ur_items VALUES (?, ?, ?)", item_rows)
+            self._con.executemany("INSERT OR IGNORE INTO ap_sources VALUES (?, ?, ?)", source_rows)
+        return ids
+
+    def _records(self, sql, params=()):
+        with self._lock:
+            rows = self._con.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def get(self, ap_id):
+        out = self._records("SELECT record FROM aps WHERE id = ?", (ap_id,))
+        return out[0] if out else None
+
+    def all(self):
+        return self._records("SELECT record FROM aps ORDER BY rowid")
+
+    # APs whose UR asks for this value of this column
+    def by_value(self, col, value, limit=None):
+        return self._records(
+            "SELECT a.record FROM ur_items i JOIN aps a ON a.id = i.ap_id"
+            " WHERE i.col = ? AND i.value = ? ORDER BY a.timestamp DESC LIMIT ?",
+            (col, canon_value(value), -1 if limit is None else limit),
+        )
+
+    # APs whose plan reads this table ("src42")
+    def by_source(self, source, limit=None):
+        return self._records(
+            "SELECT a.record FROM ap_sources s JOIN aps a ON a.id = s.ap_id"
+            " WHERE s.source = ? ORDER BY a.timestamp DESC LIMIT ?",
+            (source, -1 if limit is None else limit),
+        )
+
+    def recent(self, since=None, limit=100):
+        return self._records(
+            "SELECT record FROM aps WHERE timestamp >= ? ORDER BY timestamp DESC LIMIT ?",
+            (since or 0, -1 if limit is None else limit),
+        )
+
+    # APs stored for the same UR (any spelling of it)
+    def find_exact(self, UR, split=None):
+        return self._records(
+            "SELECT record FROM aps WHERE ur_key = ? AND (? IS NULL OR split = ?) ORDER BY timestamp DESC",
+            (canonical_ur(UR), split, split),
+        )
+
+    # Subsumption: APs whose UR contains every (column, value) of this UR, tightest first
+    # (fewest extra items, then newest). Their plans scan every source that matches the UR,
+    # but their WHERE clauses may also match the extra items, so prune the result with this UR.
+    # An empty UR matches nothing.
+    def find_covering(self, UR, split=None, limit=10):
+        items = _ur_items(UR)
+        if not items:
+            return []
+        values = ", ".join("(?, ?)" for _ in items)
+        sql = (
+            f"WITH wanted(col, value) AS (VALUES {values}) "
+            "SELECT a.record FROM wanted w JOIN ur_items i ON i.col = w.col AND i.value = w.value "
+            "JOIN aps a ON a.id = i.ap_id WHERE (? IS NULL OR a.split = ?) "
+            "GROUP BY a.id HAVING COUNT(*) = ? "
+            "ORDER BY a.n_items, a.timestamp DESC LIMIT ?"
+        )
+        params = [x for item in items for x in item] + [split, split, len(items), -1 if limit is None else limit]
+        return self._records(sql, params)
+
+
+# JsonlAPStore for a .jsonl path, SQLiteAPStore otherwise
+def open_ap_store(path):
+    if path.endswith(".jsonl"):
+        return JsonlAPStore(path)
+    return SQLiteAPStore(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import and query the local AP store.")
+    parser.add_argument("db", help="SQLite AP store (created if missing)")
+    parser.add_argument("--import", dest="imports", nargs="+", default=[], metavar="JSONL",
+                        help="AP JSONL files to bulk insert (ap_corpus.jsonl, batch.py output, a JsonlAPStore file)")
+    parser.add_argument("--covering", default=None, metavar="UR_JSON", help="print the APs that cover this UR")
+    parser.add_argument("--source", default=None, help="print the APs reading this table (e.g. src42)")
+    parser.add_argument("--split", default=None, help="restrict --covering to APs of this split")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    store = SQLiteAPStore(args.db)
+    for path in args.imports:
+        t0 = time.perf_counter()
+        with open(path) as f:
+            ids = store.store_many(json.loads(line) for line in f if line.strip())
+        print(f"{path}: {len(ids)} APs in {time.perf_counter() - t0:.2f}s", file=sys.stderr)
+
+    found = []
+    if args.covering:
+        found = store.find_covering(json.loads(args.covering), split=args.split, limit=args.limit)
+    elif args.source:
+        found = store.by_source(args.source, limit=args.limit)
+    for ap in found:
+        print(json.dumps(ap))
+    print(f"{len(store)} APs in {args.db}", file=sys.stderr)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from multiprocessing import Pool
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.gen_ap import load_stats, plan_ap, source_table
+from demo.nl_to_ur import load_compiled_lexicon
+
+LEXICON_PATH = os.path.join(PROJECT_ROOT, "demo", "lexicon.json")
+
+# Batch NL -> UR -> AP over a JSONL of queries.
+# Each input line is {"nl": ...} and/or {"ur": {...}}; when "ur" is given it is used as is,
+# otherwise it is parsed from "nl". The lexicon and the stats are loaded once per process
+# (once in total with workers=1), and output lines have the shape of ap_corpus.jsonl.
+
+# per-process state, filled by _init_worker
+_STATE = {}
+
+
+def _init_worker(split_path, lexicon_path, mode, cost_model):
+    _STATE["lexicon"] = load_compiled_lexicon(lexicon_path)
+    _STATE["stats"] = load_stats(split_path)
+    _STATE["mode"] = mode
+    _STATE["cost_model"] = cost_model
+
+
+# One query: parse if needed, then order + plan.
+def _plan_one(query):
+    ur = query.get("ur")
+    if ur is None:
+        ur = _STATE["lexicon"].parse(query.get("nl", ""), mode=_STATE["mode"])
+    order, plan, cur = plan_ap(ur, _STATE["stats"], cost_model=_STATE["cost_model"])
+    return ur, order, plan, cur.missing
+
+
+def _ap_record(query, ur, order, plan, dataset, split, source_files=None):
+    return {
+        "nl": query.get("nl"),
+        "ur": ur,
+        "ap": {
+            "source_order": [source_table(i, source_files) for i in order],
+            "sql_plan": plan,
+            "meta": {
+                "dataset": dataset,
+                "split": split,
+                "ap_len": len(order),
+                "fill_mode": False,
+            },
+        },
+    }
+
+
+# Split name of the corpus meta: the folder name without the dataset prefix
+# (data/MATHE_random_100 -> random_100, .../MATHE/random_100 -> random_100).
+def split_name(split_path, dataset="MATHE"):
+    name = os.path.basename(os.path.normpath(split_path))
+    prefix = f"{dataset}_"
+    return name[len(prefix):] if name.startswith(prefix) and len(name) > len(prefix) else name
+
+
+def read_queries(path):
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# Parse and plan every query, yielding (query, ur, order, plan, missing) in input order.
+# workers > 1 spreads the queries over a process pool, each worker loading the state once.
+def plan_batch(queries, split_path, lexicon_path=LEXICON_PATH, mode="subset", cost_model=None,
+               workers=1, chunksize=16):
+    init_args = (split_path, lexicon_path, mode, cost_model)
+    if workers <= 1:
+        _init_worker(*init_args)
+        for q in queries:
+            yield (q, *_plan_one(q))
+        return
+
+    with Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+        # imap keeps the input order and only holds a few chunks in flight
+        queries = iter(queries)
+        pending = deque()
+
+        def feed():
+            for q in queries:
+                pending.append(q)
+                yield q
+
+        for q_res in pool.imap(_plan_one, feed(), chunksize=chunksize):
+            yield (pending.popleft(), *q_res)
+
+
+# Stream AP JSONL for the queries. With execute=True the plans are run in chunks of
+# execute_chunk queries with execute_batch (sources shared within a chunk), "rows" is added to
+# every record and each chunk is written as soon as it has run, so memory stays at one chunk.
+# scan_stats (optional dict) receives execute_batch's steps / scans / unshared totals.
+def run_batch(queries, out, split_path, lexicon_path=LEXICON_PATH, mode="subset", cost_model=None,
+              workers=1, dataset="MATHE", split=None, execute=False, use_db=True, execute_chunk=256,
+              scan_stats=None):
+    split = split or split_name(split_path, dataset)
+    n = 0
+    held = []
+    con = None
+    source_files = load_stats(split_path)["source_files"]
+
+    def flush():
+        chunk_stats = {}
+        results = execute_batch([r["ap"]["sql_plan"] for r in held], split_path, source_files=source_files,
+                                use_db=use_db, scan_stats=chunk_stats, con=con)
+        for rec, df in zip(held, results):
+            rec["rows"] = len(df)
+            out.write(json.dumps(rec) + "\n")
+        held.clear()
+        if scan_stats is not None:
+            for k, v in chunk_stats.items():
+                scan_stats[k] = scan_stats.get(k, 0) + v
+
+    if execute:
+        from demo.execute_ap import execute_batch, open_split_connection
+
+        con = open_split_connection(split_path, source_files, use_db)
+    try:
+        for q, ur, order, plan, missing in plan_batch(queries, split_path, lexicon_path, mode, cost_model, workers):
+            rec = _ap_record(q, ur, order, plan, dataset, split, source_files)
+            if "id" in q:
+                rec = {"id": q["id"], **rec}
+            if missing:
+                rec["ap"]["missing"] = [[col, v] for col, v in missing]
+            n += 1
+            if execute:
+                held.append(rec)
+                if len(held) >= execute_chunk:
+                    flush()
+            else:
+                out.write(json.dumps(rec) + "\n")
+        if held:
+            flush()
+    finally:
+        if con is not None:
+            con.close()
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch NL/UR -> AP JSONL (same shape as ap_corpus.jsonl).")
+    parser.add_argument("input", help="JSONL with 'nl' and/or 'ur' per line ('-' for stdin)")
+    parser.add_argument("split", help="split folder with the stats files (and CSVs for --execute)")
+    parser.add_argument("-o", "--out", default="-", help="output JSONL ('-' for stdout)")
+    parser.add_argument("--lexicon", default=LEXICON_PATH)
+    parser.add_argument("--mode", choices=["subset", "contiguous"], default="subset")
+    parser.add_argument("--cost-model", default=None, help="lazy greedy cost model (default: gen_ap_order)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dataset", default="MATHE")
+    parser.add_argument("--split-name", default=None, help="meta.split (default: the folder name without '<dataset>_')")
+    parser.add_argument("--execute", action="store_true", help="also run the plans and report row counts")
+    parser.add_argument("--no-db", action="store_true", help="read the CSVs directly instead of split.duckdb")
+    parser.add_argument("--execute-chunk", type=int, default=256, help="queries per execute_batch call with --execute")
+    args = parser.parse_args()
+
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    try:
+        n = run_batch(
+            read_queries(args.input), out, args.split,
+            lexicon_path=args.lexicon, mode=args.mode, cost_model=args.cost_model,
+            workers=args.workers, dataset=args.dataset, split=args.split_name,
+            execute=args.execute, use_db=not args.no_db, execute_chunk=args.execute_chunk,
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"{n} APs written", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.gen_ap import load_stats, plan_ap
+from demo.value_encoding import canon_value
+
+# Files whose change invalidates everything cached for a split (besides the CSVs themselves).
+STATS_FILES = ("stats.npz", "stats.parquet", "value_index.json", "source_files.json")
+
+
+# Fingerprint of a split: name, mtime and size of the stats files and of every CSV.
+# Cheap (one stat per file), and any regenerated stats file or edited CSV gives a new value.
+def split_fingerprint(split_path):
+    h = hashlib.sha1()
+    for fname in sorted(os.listdir(split_path)):
+        if fname.endswith(".csv") or fname in STATS_FILES:
+            st = os.stat(os.path.join(split_path, fname))
+            h.update(f"{fname}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+    return h.hexdigest()
+
+
+# Canonical form of a UR: columns sorted, values canonicalized (80 == 80.0, strings as written),
+# deduplicated and sorted. Used to find stored APs for the same request (ap_store), not for plans.
+def canonical_ur(UR):
+    out = []
+    for col in sorted(UR):
+        vals = {canon_value(v) for v in UR[col]}
+        vals.discard(None)
+        out.append([col, sorted(vals)])
+    return json.dumps(out, separators=(",", ":"))
+
+
+# Exact form of a UR: columns sorted, values as given. The planner writes each value into the SQL
+# as spelled (18 -> IN (18), "18" -> IN ('18')), so cached plans are keyed on this, not on canonical_ur.
+def ur_key(UR):
+    return json.dumps(UR, sort_keys=True, default=_json_scalar)
+
+
+def _json_scalar(v):
+    return v.item() if hasattr(v, "item") else str(v)  # numpy scalars -> their Python value
+
+
+def plan_hash(plan):
+    return hashlib.sha1(json.dumps(plan, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _size_of(value):
+    nbytes = getattr(value, "nbytes", None)  # pyarrow.Table / numpy
+    if isinstance(nbytes, int):
+        return nbytes
+    if hasattr(value, "memory_usage"):  # DataFrame
+        return int(value.memory_usage(deep=True).sum())
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+# LRU map with a limit on the number of entries and (optionally) on their total size in bytes.
+# Safe to share between threads (get / put reorder the map).
+# path: pickle file the entries are loaded from on creation and written to by save().
+class LRUCache:
+    def __init__(self, max_entries=1024, max_bytes=None, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = _size_of(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # would evict everything else and still not fit
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.nbytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            items = list(self._data.items())
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                items = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return  # unreadable cache file -> start empty
+        for key, (value, size) in items:
+            self._data[key] = (value, size)
+            self.nbytes += size
+        # the limits may have changed since the file was written
+        while len(self._data) > self.max_entries or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            _, (_, old_size) = self._data.popitem(last=False)
+            self.nbytes -= old_size
+
+
+# Two-level cache for one split:
+#   plans   : (split fingerprint, UR, cost model) -> (order, plan, compiled UR)
+#   results : ("exec", split fingerprint, plan hash, execute_ap kwargs) -> executed pyarrow.Table
+#             ("pruned", split fingerprint, plan hash, UR) -> pruned pyarrow.Table
+# Every key carries the split fingerprint, so entries of an older version of the split are
+# never returned (they just age out of the LRU). The stats themselves are reloaded whenever
+# the fingerprint changes. The fingerprint (a stat of every file) is recomputed at most every
+# check_interval seconds, so a change to the split is seen within that delay.
+# URs are keyed exactly (ur_key): a cached plan and compiled UR are the ones plan_ap would build
+# for this very UR.
+# cache_dir: where plans.pkl / results.pkl are kept by save() (None = memory only).
+class PipelineCache:
+    def __init__(self, split_path, max_plans=4096, max_results=256, max_result_bytes=256 * 2**20, cache_dir=None,
+                 check_interval=1.0):
+        self.split_path = split_path
+        self.check_interval = check_interval
+        self.plans = LRUCache(max_plans, path=cache_dir and os.path.join(cache_dir, "plans.pkl"))
+        self.results = LRUCache(max_results, max_result_bytes, path=cache_dir and os.path.join(cache_dir, "results.pkl"))
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._fingerprint = None
+        self._checked_at = None
+        self._stats = None
+
+    def fingerprint(self):
+        return split_fingerprint(self.split_path)
+
+    # load_stats, redone only when the split changed
+    def stats_data(self):
+        now = time.monotonic()
+        if self._stats is not None and now - self._checked_at < self.check_interval:
+            return self._stats
+        fp = self.fingerprint()
+        if self._stats is None or fp != self._fingerprint:
+            self._stats = load_stats(self.split_path)
+            self._fingerprint = fp
+        self._checked_at = now
+        return self._stats
+
+    def plan(self, UR, cost_model=None):
+        stats = self.stats_data()
+        key = (self._fingerprint, ur_key(UR), cost_model)
+        hit = self.plans.get(key)
+        if hit is None:
+            hit = plan_ap(UR, stats, cost_model=cost_model)
+            self.plans.put(key, hit)
+        return hit
+
+    # execute_ap result of the plan, as a pyarrow Table
+    def execute(self, plan, **kwargs):
+        from demo.execute_ap import execute_ap
+
+        stats = self.stats_data()
+        key = ("exec", self._fingerprint, plan_hash(plan), json.dumps(kwargs, sort_keys=True))
+        hit = self.results.get(key)
+        if hit is None:
+            hit = execute_ap(plan, self.split_path, source_files=stats.get("source_files"), as_arrow=True, **kwargs)
+            self.results.put(key, hit)
+        return hit
+
+    # EPrune of the (cached) execution result, as a pyarrow Table
+    def pruned(self, plan, UR):
+        import pyarrow as pa
+        from demo.utils import EPrune
+
+        self.stats_data()
+        key = ("pruned", self._fingerprint, plan_hash(plan), ur_key(UR))
+        hit = self.results.get(key)
+        if hit is None:
+            table = self.execute(plan)
+            hit = pa.Table.from_pandas(EPrune(table.to_pandas(), UR), preserve_index=False)
+            self.results.put(key, hit)
+        return hit
+
+    def stats(self):
+        return {"plans": self.plans.stats(), "results": self.results.stats()}
+
+    def save(self):
+        self.plans.save()
+        self.results.save()
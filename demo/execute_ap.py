@@ -1,52 +1,742 @@
+import contextlib
+import contextvars
 import duckdb
+import hashlib
+import json
 import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def execute_ap(plan, split_path, source_files=None):
-    """
-    plan: list of {"table": ..., "sql": ...}
-    split_path: path to folder with src_*.csv
-    """
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.gen_ap import _sql_literal
+from demo.trace import count, span
+from demo.utils import _prune_multi_rows
 
-    con = duckdb.connect(database=":memory:")
 
-    # 1) register all CSV sources
-    csv_files = sorted(
+DB_FILE = "split.duckdb"
+INGEST_VERSION = 2
+_INGEST_LOCK_TIMEOUT_S = 30
+_STALE_GENERATION_S = 60  # a replaced generation is removed after this (readers only need it while they attach it)
+_ABANDONED_GENERATION_S = 3600  # unfinished files of crashed writers
+
+
+def _csv_files(split_path):
+    return sorted(
         f for f in os.listdir(split_path)
         if f.endswith(".csv")
     )
 
-    for i, fname in enumerate(csv_files):
-        if source_files:
-            table_name = source_files[i]   
+
+def _sql_path(path):
+    return path.replace("'", "''")
+
+
+def _file_state(split_path, fname):
+    st = os.stat(os.path.join(split_path, fname))
+    return [st.st_mtime_ns, st.st_size]
+
+
+# {"version", "db", "files"} of the generation in use, None if there is none (or only the
+# single-file layout of older versions)
+def _read_ingest_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != INGEST_VERSION:
+        return None
+    return manifest
+
+
+# path of the generation in use if it is up to date for `needed` (and holds no other files when
+# exact), else None
+def _fresh_generation(split_path, manifest_path, needed, exact):
+    manifest = _read_ingest_manifest(manifest_path)
+    if manifest is None:
+        return None
+    db = os.path.join(os.path.dirname(manifest_path), manifest["db"])
+    known = manifest["files"]
+    if not os.path.exists(db) or (exact and set(known) != set(needed)):
+        return None
+    if any(known.get(f) != _file_state(split_path, f) for f in needed):
+        return None
+    return db
+
+
+# Exclusive lock shared by all ingesting threads and processes; yields False if it could not be
+# taken within timeout, or the lock file cannot be created (read-only split directory).
+@contextlib.contextmanager
+def _ingest_lock(lock_path, timeout):
+    try:
+        f = open(lock_path, "a")
+    except OSError:
+        yield False
+        return
+    with f:
+        if fcntl is None:  # no advisory locks (Windows): writers only race on the manifest swap
+            yield True
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(0.05)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def ingest_split(split_path, db_path=None, force=False, files=None, lock_timeout=None):
+    """
+    Materialize the split's CSVs into a persistent DuckDB file (one table per CSV stem).
+    Each ingestion writes a new generation, split.<hash>.duckdb, and then switches the
+    manifest (split_ingest.json: db name + per-file mtime / size) to it atomically, so
+    connections still attached to the previous generation keep working. A generation
+    starts as a file copy of the previous one: only new or changed CSVs (mtime / size)
+    are re-read, and tables of deleted CSVs are dropped.
+    Writers serialize on split_ingest.lock; a caller that finds the split up to date
+    does not take the lock or open the database.
+    files: only these CSV names need to be up to date (e.g. the ones a plan needs).
+    Returns the path to attach (read-only), or None when the split cannot be ingested
+    (read-only directory, or another writer holding the lock past lock_timeout,
+    default _INGEST_LOCK_TIMEOUT_S seconds) and
+    there is no up-to-date generation: the caller should read the CSVs directly.
+    """
+    db_path = db_path or os.path.join(split_path, DB_FILE)
+    stem = os.path.splitext(db_path)[0]
+    manifest_path = stem + "_ingest.json"
+    needed = _csv_files(split_path) if files is None else sorted(files)
+
+    if not force:
+        db = _fresh_generation(split_path, manifest_path, needed, exact=files is None)
+        if db:
+            return db
+    if lock_timeout is None:
+        lock_timeout = _INGEST_LOCK_TIMEOUT_S
+    with _ingest_lock(stem + "_ingest.lock", lock_timeout) as locked:
+        if locked:
+            # another writer may have finished while we waited
+            db = None if force else _fresh_generation(split_path, manifest_path, needed, files is None)
+            return db or _write_generation(split_path, stem, manifest_path, force)
+    return _fresh_generation(split_path, manifest_path, needed, exact=files is None)
+
+
+def _write_generation(split_path, stem, manifest_path, force):
+    current = {fname: _file_state(split_path, fname) for fname in _csv_files(split_path)}
+    previous = _read_ingest_manifest(manifest_path)
+    prev_db = previous and os.path.join(os.path.dirname(stem), previous["db"])
+    if prev_db and not os.path.exists(prev_db):
+        prev_db = None
+    prev_files = previous["files"] if prev_db and not force else {}
+
+    key = json.dumps(current, sort_keys=True) + (f":{time.time_ns()}" if force else "")
+    name = f"{os.path.basename(stem)}.{hashlib.sha1(key.encode()).hexdigest()[:12]}.duckdb"
+    db = os.path.join(os.path.dirname(stem), name)
+    # an identical generation is already on disk (e.g. the CSVs were restored): reuse it
+    if not os.path.exists(db):
+        tmp = f"{db}.{os.getpid()}.tmp"
+        for leftover in (tmp, tmp + ".wal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        # start from a file copy of the previous generation: it is never written to, and the
+        # copy is a new file, so nobody has it attached
+        if prev_files:
+            shutil.copyfile(prev_db, tmp)
+        con = duckdb.connect(database=tmp)
+        try:
+            for fname in prev_files:
+                if fname not in current:
+                    con.execute(f'DROP TABLE IF EXISTS "{os.path.splitext(fname)[0]}";')
+            for fname, state in current.items():
+                if prev_files.get(fname) != state:
+                    csv_path = os.path.join(split_path, fname)
+                    con.execute(f"""
+                        CREATE OR REPLACE TABLE "{os.path.splitext(fname)[0]}" AS
+                        SELECT * FROM read_csv_auto('{_sql_path(csv_path)}');
+                    """)
+            con.execute("CHECKPOINT;")
+        finally:
+            con.close()
+        os.replace(tmp, db)
+
+    fd, tmp = tempfile.mkstemp(prefix="ingest-", suffix=".tmp", dir=os.path.dirname(manifest_path))
+    with os.fdopen(fd, "w") as f:
+        json.dump({"version": INGEST_VERSION, "db": name, "files": current}, f)
+    os.replace(tmp, manifest_path)
+    if prev_db and prev_db != db:
+        os.utime(prev_db)  # starts its grace period in _prune_generations
+    _prune_generations(stem, db)
+    return db
+
+
+# Remove replaced generations once no reader can still be attaching them, files of crashed
+# writers, and the single split.duckdb of older versions.
+def _prune_generations(stem, current):
+    folder, base = os.path.split(stem)
+    now = time.time()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if path == current or not name.startswith(base + "."):
+            continue
+        if name in (base + ".duckdb", base + ".duckdb.wal"):
+            age = None
+        elif name.endswith(".duckdb"):
+            age = _STALE_GENERATION_S
+        elif name.endswith(".tmp") or name.endswith(".tmp.wal"):
+            age = _ABANDONED_GENERATION_S
+        else:
+            continue
+        try:
+            if age is None or now - os.path.getmtime(path) > age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+# Plan table name -> CSV file name, with the same naming rule as the stats:
+# the names in source_files (CSV stems or file names, in stats row order) if given,
+# else src{i+1} over the sorted CSVs.
+def _table_files(split_path, source_files=None):
+    csv_files = _csv_files(split_path)
+    if source_files:
+        by_name = {}
+        for fname in csv_files:
+            by_name[fname] = fname
+            by_name[os.path.splitext(fname)[0]] = fname
+        return {name: by_name[name] for name in source_files if name in by_name}
+    return {f"src{i+1}": fname for i, fname in enumerate(csv_files)}
+
+
+# Open an in-memory connection with a view for every table the plan references.
+# The views are regular (not TEMP) so cursors of the same connection see them too.
+# con: a warm connection from open_split_connection; a new cursor of it is returned instead
+# (its own temp tables and registrations, the shared views).
+def _connect_for_plan(plan, split_path, source_files=None, use_db=True, con=None):
+    if con is not None:
+        return con.cursor()
+    con = duckdb.connect(database=":memory:")
+
+    table_files = _table_files(split_path, source_files)
+    tables = list(dict.fromkeys(step["table"] for step in plan))
+    unknown = [t for t in tables if t not in table_files]
+    if unknown:
+        con.close()
+        raise ValueError(f"Plan references unknown tables: {unknown}")
+
+    db_path = None
+    if use_db and tables:
+        db_path = ingest_split(split_path, files=[table_files[t] for t in tables])
+    if db_path:
+        con.execute(f"ATTACH '{_sql_path(db_path)}' AS split (READ_ONLY);")
+
+    for table_name in tables:
+        fname = table_files[table_name]
+        if db_path:
+            stem = os.path.splitext(fname)[0]
+            con.execute(f'CREATE VIEW "{table_name}" AS SELECT * FROM split."{stem}";')
         else:
-            table_name = f"src{i+1}"
+            csv_path = os.path.join(split_path, fname)
+            con.execute(f"""
+                CREATE VIEW "{table_name}" AS
+                SELECT * FROM read_csv_auto('{_sql_path(csv_path)}');
+            """)
+    return con
+
+
+# A long-lived connection with a view for every source of the split, for callers that run many
+# plans (e.g. demo/service.py): pass it as con= to execute_ap / execute_ap_pruned / execute_batch
+# to skip the per-call connect + ATTACH. Each call then works on its own cursor, so it is safe
+# to share between threads. Reopen it after the split's CSVs change.
+def open_split_connection(split_path, source_files=None, use_db=True):
+    tables = [{"table": t} for t in _table_files(split_path, source_files)]
+    return _connect_for_plan(tables, split_path, source_files, use_db)
+
+
+# The whole plan as one query: UNION (not UNION ALL) of the step selects, so DuckDB does the dedup.
+def plan_to_union_sql(plan):
+    return "\nUNION\n".join(f"({step['sql']})" for step in plan)
+
+
+# Run every step on its own cursor in a thread pool; each step's rows come back as Arrow batches.
+def _run_steps_parallel(con, plan, workers):
+    def run(step):
+        with span("step", table=step["table"]) as sp:
+            cur = con.cursor()
+            try:
+                table = cur.execute(step["sql"]).fetch_record_batch().read_all()
+            finally:
+                cur.close()
+            sp.set(rows=table.num_rows)
+        return table
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(plan)))) as pool:
+        # each step runs in a copy of the caller's context, so its spans reach the active tracer
+        ctxs = [contextvars.copy_context() for _ in plan]
+        return list(pool.map(lambda ctx, step: ctx.run(run, step), ctxs, plan))
+
+
+def execute_ap(plan, split_path, source_files=None, use_db=True, mode="steps", as_arrow=False, workers=4, con=None):
+    """
+    plan: list of {"table": ..., "sql": ...}
+    split_path: path to folder with src_*.csv
+    use_db: attach the persistent split.duckdb (ingested / refreshed on demand)
+            instead of reading the CSVs directly; falls back to the CSVs when the
+            split cannot be ingested (see ingest_split)
+    mode:
+      "steps" -> one fetch per step, then pandas concat + drop_duplicates
+      "union" -> one UNION query for the whole plan, deduplicated inside DuckDB
+      "parallel" -> steps run concurrently on up to `workers` cursors, the Arrow
+                    results are then deduplicated with a UNION (same rows as "union")
+    as_arrow: return a pyarrow Table instead of a DataFrame
+    con: warm connection from open_split_connection (default: a new one for this call)
+    Only the tables referenced by the plan are registered, as views.
+    """
+    if mode not in ("steps", "union", "parallel"):
+        raise ValueError(f"Unknown execution mode: {mode!r}")
+
+    with span("execute", mode=mode, steps=len(plan)) as sp:
+        out = _execute_ap(plan, split_path, source_files, use_db, mode, as_arrow, workers, con)
+        n_rows = _num_rows(out)
+        sp.set(rows=n_rows)
+        count("sources_scanned", len(plan))
+        count("rows_returned", n_rows)
+    return out
+
+
+def _num_rows(result):
+    return result.num_rows if isinstance(result, pa.Table) else len(result)
 
-        csv_path = os.path.join(split_path, fname)
 
-        # Make reruns safe + handle special chars
-        con.execute(f'DROP TABLE IF EXISTS "{table_name}";')
-        con.execute(f"""
-            CREATE TEMP TABLE "{table_name}" AS
-            SELECT * FROM read_csv_auto('{csv_path}');
-        """)
-    print(con.execute("DESCRIBE src_1").fetchdf())
-    print(con.execute("SELECT typeof(newLevel) t, count(*) c FROM src_1 GROUP BY 1").fetchdf())
-    print(con.execute("SELECT count(*) FROM src_1 WHERE newLevel='2'").fetchone())
-    print(con.execute("SELECT count(*) FROM src_1 WHERE newLevel=2").fetchone()) 
+def _execute_ap(plan, split_path, source_files, use_db, mode, as_arrow, workers, shared_con):
+    # 1) register the sources the plan uses
+    con = _connect_for_plan(plan, split_path, source_files, use_db, shared_con)
 
-    # 2) execute AP SQL steps
-    results = []
+    try:
+        if mode == "union":
+            if not plan:
+                return _empty_result(as_arrow)
+            rel = con.execute(plan_to_union_sql(plan))
+            return rel.fetch_arrow_table() if as_arrow else rel.fetchdf()
 
-    for step in plan:
-        df = con.execute(step["sql"]).fetchdf()
-        results.append(df)
+        if mode == "parallel":
+            if not plan:
+                return _empty_result(as_arrow)
+            tables = _run_steps_parallel(con, plan, workers)
+            for i, tbl in enumerate(tables):
+                con.register(f"_step_{i}", tbl)
+            rel = con.execute("\nUNION\n".join(f"SELECT * FROM _step_{i}" for i in range(len(tables))))
+            return rel.fetch_arrow_table() if as_arrow else rel.fetchdf()
 
-    con.close()
+        # 2) execute AP SQL steps
+        results = []
+
+        for step in plan:
+            df = con.execute(step["sql"]).fetchdf()
+            results.append(df)
+    finally:
+        con.close()
 
     # 3) concat results
     if results:
-        return pd.concat(results, ignore_index=True).drop_duplicates()
+        out = pd.concat(results, ignore_index=True).drop_duplicates()
+    else:
+        out = pd.DataFrame()
+    if as_arrow:
+        return pa.Table.from_pandas(out, preserve_index=False)
+    return out
+
+
+def _empty_result(as_arrow):
+    if as_arrow:
+        return pa.table({})
+    return pd.DataFrame()
+
+
+# ---- batch execution ----
+# A plan step is "SELECT [DISTINCT] cols FROM table WHERE cond" (see gen_ap.build_sql_plan).
+_STEP_SQL_RE = re.compile(
+    r"\s*SELECT\s+(DISTINCT\s+)?(.+?)\s+FROM\s+(\S+)\s+WHERE\s+(.+?)\s*;?\s*", re.IGNORECASE | re.DOTALL
+)
+# anything that would not survive being wrapped as (cond) -> the step is run on its own;
+# tested outside quoted literals / identifiers ('Order of operations' is a plain value)
+_NOT_A_PREDICATE_RE = re.compile(r"\b(ORDER|GROUP|LIMIT|UNION|HAVING|QUALIFY)\b", re.IGNORECASE)
+_QUOTED_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+
+def _split_step_sql(sql):
+    m = _STEP_SQL_RE.fullmatch(sql)
+    if m is None or _NOT_A_PREDICATE_RE.search(_QUOTED_RE.sub("''", m.group(4))):
+        return None
+    cols = [c.strip() for c in m.group(2).split(",")]
+    return bool(m.group(1)), cols, m.group(3), m.group(4)
+
+
+# One scan of a table for all the steps that target it:
+#   SELECT <all their columns>, (cond_0) AS __q0, ... FROM table WHERE cond_0 OR cond_1 ...
+# fetched once; each step then takes its rows (__qN) and columns back out of it, deduplicated
+# when the step is a SELECT DISTINCT.
+# Steps whose SQL is not a plain select-where on that table are run on their own (the others are
+# still merged). Returns (one DataFrame per step, table scans run, steps that could not be merged).
+def _run_shared_scan(con, steps):
+    parsed = [_split_step_sql(step["sql"]) for step in steps]
+    tables = [p[2] for p in parsed if p is not None]
+    table = max(set(tables), key=tables.count) if tables else None
+    merged = [i for i, p in enumerate(parsed) if p is not None and p[2] == table]
+    n_unmerged = len(steps) - len(merged)
+    if len(merged) < 2:
+        merged = []
+
+    out = [None] * len(steps)
+    for i, step in enumerate(steps):
+        if i not in merged:
+            out[i] = con.execute(step["sql"]).fetchdf()
+    if not merged:
+        return out, len(steps), n_unmerged
+
+    if any(parsed[i][1] == ["*"] for i in merged):
+        cols = "*"
     else:
-        return pd.DataFrame()
\ No newline at end of file
+        cols = ", ".join(dict.fromkeys(c for i in merged for c in parsed[i][1]))
+    flags = ", ".join(f"COALESCE(({parsed[i][3]}), false) AS __q{i}" for i in merged)
+    where = " OR ".join(f"({parsed[i][3]})" for i in merged)
+    scan = con.execute(f"SELECT {cols}, {flags} FROM {table} WHERE {where};").fetchdf()
+    src_cols = [c for c in scan.columns if not c.startswith("__q")]
+
+    for i in merged:
+        distinct, step_cols, _, _ = parsed[i]
+        if step_cols == ["*"]:
+            step_cols = src_cols
+        else:
+            step_cols = [c.strip('"') for c in step_cols]
+        df = scan.loc[scan[f"__q{i}"].to_numpy(), step_cols].reset_index(drop=True)
+        out[i] = df.drop_duplicates(ignore_index=True) if distinct else df
+    return out, len(steps) - len(merged) + 1, n_unmerged
+
+
+# Execute many plans on one connection: every table any plan needs is registered once.
+# shared=True merges all the steps that target a table into one scan of it (_run_shared_scan);
+# shared=False runs the steps one by one, grouped by table.
+# Returns one DataFrame per plan, same as execute_ap(mode="steps") would.
+# scan_stats (optional dict) receives the number of steps, of table scans actually run and of
+# steps that shared=True could not merge into their table's scan ("unshared").
+def execute_batch(plans, split_path, source_files=None, use_db=True, shared=True, scan_stats=None, con=None):
+    all_steps = [step for plan in plans for step in plan]
+    by_table = {}
+    for qi, plan in enumerate(plans):
+        for step in plan:
+            by_table.setdefault(step["table"], []).append((qi, step))
+
+    results = [[] for _ in plans]
+    n_scans = n_unshared = 0
+    with span("execute_batch", plans=len(plans), steps=len(all_steps), shared=shared) as sp:
+        con = _connect_for_plan(all_steps, split_path, source_files, use_db, con)
+        try:
+            for table, steps in by_table.items():
+                with span("scan", table=table, steps=len(steps)):
+                    if shared:
+                        dfs, n, unmerged = _run_shared_scan(con, [step for _, step in steps])
+                        n_unshared += unmerged
+                    else:
+                        dfs, n = [con.execute(step["sql"]).fetchdf() for _, step in steps], len(steps)
+                n_scans += n
+                for (qi, _), df in zip(steps, dfs):
+                    results[qi].append(df)
+        finally:
+            con.close()
+
+        out = [
+            pd.concat(dfs, ignore_index=True).drop_duplicates() if dfs else pd.DataFrame()
+            for dfs in results
+        ]
+        sp.set(scans=n_scans, unshared=n_unshared)
+        count("sources_scanned", n_scans)
+        count("rows_returned", sum(len(df) for df in out))
+
+    if scan_stats is not None:
+        scan_stats["steps"] = len(all_steps)
+        scan_stats["scans"] = n_scans
+        scan_stats["unshared"] = n_unshared
+    return out
+
+
+# ---- pruning inside DuckDB ----
+# Same keep/drop rule as utils.EPrune, applied to the plan result while it stays in DuckDB:
+#   _r : the deduplicated plan result with a row id (_rid = visiting order on ties)
+#   _m : per row, the id of its UR item in each UR column (NULL = no item) and _S_size
+# Item-less rows are dropped; single-item rows (which EPrune visits first, as _S_size = 1)
+# are solved with a row_number() window per item: the first count-1 of them go.
+# Only the narrow (_rid, item id) rows with 2+ items are fetched for the sequential pass,
+# and only the kept rows are returned.
+_NUMERIC_TYPES = {
+    "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT",
+    "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "UHUGEINT", "FLOAT", "DOUBLE",
+}
+
+
+# UR values as SQL literals of the column's type, keeping only the values pandas' isin would
+# match on the fetched column (so the prune agrees with EPrune): numbers and bools (as 1 / 0)
+# on numeric columns, strings on VARCHAR, bools and 0 / 1 on BOOLEAN. Other values, None and
+# NaN can never match.
+def _sql_in_list(vals, col_type):
+    lits = []
+    for v in vals:
+        if v is None or (isinstance(v, (float, np.floating)) and v != v):
+            continue
+        is_bool = isinstance(v, (bool, np.bool_))
+        is_number = isinstance(v, (int, float, np.number)) and not is_bool
+        if col_type in _NUMERIC_TYPES or col_type.startswith("DECIMAL"):
+            if is_bool or isinstance(v, (int, np.integer)):
+                lits.append(str(int(v)))
+            elif is_number:
+                lits.append(f"'{float(v)!r}'::DOUBLE")
+        elif col_type == "BOOLEAN":
+            if is_bool or (is_number and v in (0, 1)):
+                lits.append("TRUE" if v else "FALSE")
+        elif col_type == "VARCHAR":
+            if isinstance(v, str):
+                lits.append(_sql_literal(v))
+    return ", ".join(dict.fromkeys(lits))
+
+
+def _prune_in_duckdb(con, UR, as_arrow=False):
+    col_types = {r[0]: r[1] for r in con.execute("DESCRIBE _r").fetchall() if r[0] != "_rid"}
+    cols = [c for c in UR if c in col_types]
+    final_sql = "SELECT * EXCLUDE (_rid) FROM _r {where} ORDER BY _rid"
+
+    if not cols:
+        rel = con.execute(final_sql.format(where=""))
+        return rel.fetch_arrow_table() if as_arrow else rel.fetchdf()
+
+    id_exprs = []
+    for k, col in enumerate(cols):
+        in_list = _sql_in_list(UR[col], col_types[col])
+        hit = f'coalesce("{col}" IN ({in_list}), false)' if in_list else "false"
+        id_exprs.append(
+            f"CASE WHEN {hit} THEN ({k}::BIGINT << 32) + dense_rank() OVER (PARTITION BY {hit} ORDER BY \"{col}\") END AS _i{k}"
+        )
+    item_cols = [f"_i{k}" for k in range(len(cols))]
+    s_expr = " + ".join(f"({c} IS NOT NULL)::INT" for c in item_cols)
+
+    con.execute(f"""
+        CREATE TEMP TABLE _m AS
+        SELECT *, {s_expr} AS _s, CASE WHEN {s_expr} = 1 THEN coalesce({", ".join(item_cols)}) END AS _single
+        FROM (SELECT _rid, {", ".join(id_exprs)} FROM _r);
+    """)
+    con.execute(f"""
+        CREATE TEMP TABLE _cnt AS
+        SELECT _item, count(*) AS n FROM (
+            {" UNION ALL ".join(f"SELECT {c} AS _item FROM _m WHERE {c} IS NOT NULL" for c in item_cols)}
+        ) GROUP BY _item;
+    """)
+    con.execute("""
+        CREATE TEMP TABLE _drop AS
+        SELECT _rid FROM _m WHERE _s = 0
+        UNION ALL
+        SELECT _rid FROM (
+            SELECT _rid, _single, row_number() OVER (PARTITION BY _single ORDER BY _rid) AS _rank
+            FROM _m WHERE _single IS NOT NULL
+        ) JOIN _cnt ON _cnt._item = _single
+        WHERE _rank < n;
+    """)
+
+    multi = con.execute(
+        f"SELECT _rid, {', '.join(item_cols)} FROM _m WHERE _s >= 2 ORDER BY _s, _rid"
+    ).fetchnumpy()
+    if len(multi["_rid"]):
+        counts = con.execute("""
+            SELECT c._item, c.n - count(d._rid) AS n
+            FROM _cnt c LEFT JOIN (SELECT _rid, _single FROM _m JOIN _drop USING (_rid)) d ON d._single = c._item
+            GROUP BY c._item, c.n ORDER BY c._item
+        """).fetchnumpy()
+        item_ids = np.asarray(counts["_item"], dtype=np.int64)
+        count = np.asarray(counts["n"], dtype=np.int64)
+
+        row_items = np.full((len(multi["_rid"]), len(item_cols)), -1, dtype=np.int64)
+        for k, c in enumerate(item_cols):
+            col_ids = multi[c]
+            present = ~np.ma.getmaskarray(col_ids)
+            row_items[present, k] = np.searchsorted(item_ids, np.asarray(col_ids[present], dtype=np.int64))
+
+        multi_drop = np.zeros(len(row_items), dtype=np.bool_)
+        _prune_multi_rows(row_items, count, multi_drop)
+        con.register("_multi_drop", pa.table({"_rid": np.asarray(multi["_rid"])[multi_drop]}))
+        con.execute("INSERT INTO _drop SELECT _rid FROM _multi_drop;")
+
+    rel = con.execute(final_sql.format(where="WHERE _rid NOT IN (SELECT _rid FROM _drop)"))
+    return rel.fetch_arrow_table() if as_arrow else rel.fetchdf()
+
+
+# The plan's steps as one UNION ALL, each row tagged with _k = (step index, position in the step).
+# Deduplicating on min(_k) keeps every row's first occurrence in plan order, as the UNION of
+# execute_ap does, but deterministically, so the pruned rows match EPrune on every run.
+def _numbered_union_sql(plan):
+    return "\nUNION ALL\n".join(
+        f"(SELECT {i}::BIGINT * 4294967296 + row_number() OVER () AS _k, * FROM ({step['sql']}))"
+        for i, step in enumerate(plan)
+    )
+
+
+def execute_ap_pruned(plan, UR, split_path, source_files=None, use_db=True, as_arrow=False, con=None):
+    """
+    Execute the plan as one UNION query and prune the result inside DuckDB
+    (same keep/drop rule as utils.EPrune); only the pruned rows are fetched.
+    """
+    with span("execute_pruned", steps=len(plan)) as sp:
+        con = _connect_for_plan(plan, split_path, source_files, use_db, con)
+        try:
+            if not plan:
+                return _empty_result(as_arrow)
+            con.execute(f"""
+                CREATE TEMP TABLE _r AS
+                SELECT row_number() OVER (ORDER BY _k) AS _rid, * EXCLUDE (_k)
+                FROM (SELECT * EXCLUDE (_k), min(_k) AS _k FROM ({_numbered_union_sql(plan)}) GROUP BY ALL);
+            """)
+            rows_in = con.execute("SELECT count(*) FROM _r;").fetchone()[0]
+            out = _prune_in_duckdb(con, UR, as_arrow)
+        finally:
+            con.close()
+        n_rows = _num_rows(out)
+        sp.set(rows=rows_in, rows_out=n_rows)
+        count("sources_scanned", len(plan))
+        count("rows_returned", rows_in)
+        count("rows_pruned", rows_in - n_rows)
+    return out
+
+
+# ---- streaming execute -> prune ----
+# Yields (step index, pyarrow.RecordBatch) for every step of the plan, batch by batch,
+# so no step result is ever fully materialized.
+def iter_ap_batches(plan, split_path, source_files=None, use_db=True, batch_size=65536):
+    con = _connect_for_plan(plan, split_path, source_files, use_db)
+    try:
+        for i, step in enumerate(plan):
+            reader = con.execute(step["sql"]).fetch_record_batch(batch_size)
+            for batch in reader:
+                yield i, batch
+    finally:
+        con.close()
+
+
+class PruneStream:
+    """
+    One-pass pruning over iter_ap_batches: a row is kept iff it covers a UR
+    (col, value) item that no earlier row covered. The only state is the set of
+    covered items (at most the UR size), so memory is bounded by one batch plus
+    the UR. Rows repeated across steps are dropped as a side effect.
+
+    This is a streaming first-cover rule: every UR item present in the result is
+    still covered, but the rows kept can differ from EPrune, which needs the whole
+    result sorted by _S_size (use execute_ap_pruned for that).
+
+    Iterate to get the kept rows as RecordBatches; after iteration
+    rows_in / rows_out / batches / peak_bytes describe the run.
+    """
+
+    def __init__(self, plan, UR, split_path, source_files=None, use_db=True, batch_size=65536):
+        self.plan = plan
+        self.UR_sets = {col: set(vals) for col, vals in UR.items()}
+        self.split_path = split_path
+        self.source_files = source_files
+        self.use_db = use_db
+        self.batch_size = batch_size
+
+        self.covered = set()  # (col, value) items already covered by an emitted row
+        self._item_bytes = 0  # the (col, value) tuples in covered (getsizeof only counts the set itself)
+        self.rows_in = 0
+        self.rows_out = 0
+        self.batches = 0
+        self.peak_bytes = 0  # max of (input batch + its pandas copy + kept batch + covered items) bytes
+
+    def _keep_mask(self, df):
+        cols = [col for col in self.UR_sets if col in df.columns]
+        keep = np.zeros(len(df), dtype=bool)
+        new_items = []
+        for col in cols:
+            series = df[col]
+            mask = (series.isin(self.UR_sets[col]) & series.notna()).to_numpy()
+            if not mask.any():
+                continue
+            hit = series[mask]
+            # first row of the batch holding each value; keep it if the value is new
+            first = ~hit.duplicated(keep="first").to_numpy()
+            pos = np.flatnonzero(mask)[first]
+            for p, v in zip(pos, hit.to_numpy()[first]):
+                if (col, v) not in self.covered:
+                    keep[p] = True
+                    new_items.append((col, v))
+        self.covered.update(new_items)
+        self._item_bytes += sum(sys.getsizeof(it) + sys.getsizeof(it[0]) + sys.getsizeof(it[1]) for it in new_items)
+        return keep
+
+    def __iter__(self):
+        for _, batch in iter_ap_batches(self.plan, self.split_path, self.source_files, self.use_db, self.batch_size):
+            self.batches += 1
+            self.rows_in += batch.num_rows
+            df = batch.to_pandas()
+            keep = self._keep_mask(df)
+            kept = batch.filter(pa.array(keep))
+            self.rows_out += kept.num_rows
+            self.peak_bytes = max(
+                self.peak_bytes,
+                batch.nbytes + int(df.memory_usage(deep=True).sum()) + kept.nbytes
+                + sys.getsizeof(self.covered) + self._item_bytes,
+            )
+            del df
+            if kept.num_rows:
+                yield kept
+        count("sources_scanned", len(self.plan))
+        count("rows_returned", self.rows_in)
+        count("rows_pruned", self.rows_in - self.rows_out)
+
+    def to_pandas(self):
+        batches = list(self)
+        if not batches:
+            return pd.DataFrame()
+        return _concat_batches(batches).to_pandas()
+
+
+# Batches of different steps as one table. Their schemas can differ (columns missing from a
+# source, or typed differently); columns are matched by name and widened like pyarrow's permissive
+# promotion (null -> any, int -> float), and columns no promotion can reconcile (e.g. duration as
+# DOUBLE in one CSV and VARCHAR in another) become strings, as in the UNION of execute_ap.
+def _concat_batches(batches):
+    tables = [pa.Table.from_batches([b]) for b in batches]
+    types = {}
+    for t in tables:
+        for field in t.schema:
+            types.setdefault(field.name, set()).add(field.type)
+    as_string = set()
+    for name, ts in types.items():
+        try:
+            pa.unify_schemas([pa.schema([(name, t)]) for t in ts], promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            as_string.add(name)
+    for k, t in enumerate(tables):
+        for i, name in enumerate(t.schema.names):
+            if name in as_string and t.schema.field(i).type != pa.string():
+                t = t.set_column(i, name, t.column(i).cast(pa.string()))
+        tables[k] = t
+    return pa.concat_tables(tables, promote_options="permissive")
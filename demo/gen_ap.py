@@ -1,129 +1,276 @@
-import json, time, os
-import pandas as pd
-def _stats_keys(col, v):
-    if isinstance(v, int):
-        return [f"{col}:{v}", f"{col}:{float(v)}", f"{col}:{str(v)}"]
-    if isinstance(v, float):
-        iv = int(v)
-        return [f"{col}:{v}", f"{col}:{iv}", f"{col}:{str(v)}", f"{col}:{str(iv)}"]
-    return [f"{col}:{v}", f"{col}:{str(v)}"]
-# Example: _stats_keys("question_id", 80) -> ["question_id:80", "question_id:80.0", "question_id:'80'"]
+import json, time, os, sys
+import heapq
+import numpy as np
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.sparse_stats import (
+    STATS_BIN_DIR,
+    build_postings,
+    load_source_sizes_npz,
+    load_stats_bin,
+    load_stats_npz,
+    read_stats_bin_meta,
+    save_stats_bin,
+)
+from demo.trace import count, event, span
+from demo.value_encoding import canon_key, canonicalize_value_index, numeric_columns
+
 def _sql_literal(v):
     if isinstance(v, str):
         return "'" + v.replace("'", "''") + "'"
     return str(v)
 
 
+# Resolve a UR value to its value id: one lookup on the canonical key. On numeric columns
+# 80, 80.0 and "80" agree; on text columns a string must match as written.
+def _lookup_value(value_index, col, v, numeric_cols=frozenset()):
+    key = canon_key(col, v, col in numeric_cols)
+    if key is None:
+        return None
+    return value_index.get(key)
+
+
+def _get_numeric_columns(stats_data):
+    cols = stats_data.get("numeric_columns")
+    if cols is None:
+        cols = numeric_columns(stats_data["value_index"].keys())
+        stats_data["numeric_columns"] = cols
+    return cols
+
+
+def _get_postings(stats_data):
+    postings = stats_data.get("postings")
+    if postings is None:
+        postings = build_postings(stats_data["source_vectors"])
+        stats_data["postings"] = postings
+    return postings
+
+
+# A UR resolved against the value index once, shared by ordering and SQL plan building.
+#   items[k]        = (col, v) for every UR value found in the index
+#   item_sources[k] = sorted source ids holding items[k] (its postings)
+#   missing         = (col, v) pairs not in the index
+#   coverage        = source id -> item ids it covers (built from the postings on first use)
+class CompiledUR:
+    def __init__(self, ur, items, item_sources, missing):
+        self.ur = ur
+        self.items = items
+        self.item_sources = item_sources
+        self.missing = missing
+        self._coverage = None
+
+    @property
+    def coverage(self):
+        if self._coverage is None:
+            coverage = {}
+            for k, srcs in enumerate(self.item_sources):
+                for src in srcs.tolist():
+                    coverage.setdefault(src, []).append(k)
+            self._coverage = coverage
+        return self._coverage
+
+
+def compile_ur(UR, stats_data):
+    if isinstance(UR, CompiledUR):
+        return UR
+    value_index = stats_data["value_index"]
+    postings = _get_postings(stats_data)
+    numeric_cols = _get_numeric_columns(stats_data)
+
+    items, item_sources, missing = [], [], []
+    for col, vals in UR.items():
+        for v in dict.fromkeys(vals):
+            j = _lookup_value(value_index, col, v, numeric_cols)
+            srcs = postings.sources_of(j) if j is not None else None
+            # a value whose sources were all removed (incremental stats) keeps its id but has no postings
+            if srcs is None or len(srcs) == 0:
+                missing.append((col, v))
+                continue
+            items.append((col, v))
+            item_sources.append(srcs)
+    count("value_index_probes", len(items) + len(missing))
+    return CompiledUR(UR, items, item_sources, missing)
+
+
 # Given a UR and stats data, determine a good order of sources to cover the UR. This is a greedy algorithm that at each step picks the source that covers the largest number of remaining UR values.
+# Gains come from the value -> sources postings of the UR values only: each round is a bincount over
+# the postings of the still-uncovered values, so the cost follows the UR size, not sources x UR values.
+# UR can be a dict or a CompiledUR.
 def gen_ap_order(UR, stats_data):
-    value_index = stats_data["value_index"]          
-    source_vectors = stats_data["source_vectors"]   
+    cur = compile_ur(UR, stats_data)
+    item_lists = cur.item_sources
+
+    if not item_lists:
+        return []
 
-    remaining = {c: set(vs) for c, vs in UR.items()}
+    # flat (item, source) incidence over the candidate sources only
+    entry_item = np.repeat(np.arange(len(item_lists)), [len(l) for l in item_lists])
+    entry_src = np.concatenate(item_lists)
+    cand_src, entry_cand = np.unique(entry_src, return_inverse=True)
+
+    alive = np.ones(len(item_lists), dtype=bool)
     order = []
 
-    n_sources = source_vectors.shape[0]
+    while alive.any():
+        live = alive[entry_item]
+        gains = np.bincount(entry_cand[live], minlength=len(cand_src))
+        best = int(np.argmax(gains))  # first max -> lowest source id, as in the old scan
+        if gains[best] == 0:
+            break
 
-    while any(remaining.values()):
-        best_src = None
-        best_gain = 0
-        best_cover = {}
+        order.append(int(cand_src[best]))
+        alive[entry_item[live & (entry_cand == best)]] = False
 
-        for src_idx in range(n_sources):
-            if src_idx in order:
-                continue
+    return order
 
-            vec = source_vectors[src_idx]
-            gain = 0
-            cover = {}
-
-            for col, vals in remaining.items():
-                for v in vals:
-                    j = None
-                    for key in _stats_keys(col, v):
-                        j = value_index.get(key)
-                        if j is not None:
-                            break
-                    if j is None:
-                        continue
-                    if vec[j] > 0:
-                        gain += 1
-                        cover.setdefault(col, set()).add(v)
+# ---- cost models for gen_ap_order_lazy: stats_data -> per-source cost array (> 0) ----
+def unit_cost(stats_data):
+    return np.ones(_get_postings(stats_data).n_sources, dtype=np.float64)
 
-            if gain > best_gain:
-                best_gain = gain
-                best_src = src_idx
-                best_cover = cover
 
-        if best_src is None or best_gain == 0:
-            break
+def row_count_cost(stats_data):
+    rows = stats_data.get("source_rows")
+    if rows is None:
+        raise ValueError("stats have no source_rows; regenerate stats.npz to use the 'rows' cost model")
+    return np.maximum(np.asarray(rows, dtype=np.float64), 1.0)
+
+
+def scan_bytes_cost(stats_data):
+    nbytes = stats_data.get("source_bytes")
+    if nbytes is None:
+        raise ValueError("stats have no source_bytes; regenerate stats.npz to use the 'bytes' cost model")
+    return np.maximum(np.asarray(nbytes, dtype=np.float64), 1.0)
+
+
+COST_MODELS = {
+    "unit": unit_cost,
+    "rows": row_count_cost,
+    "bytes": scan_bytes_cost,
+}
+
+
+# Lazy-greedy version of gen_ap_order: a max-heap of (gain / cost) scores that are only
+# upper bounds (gains never grow), and only the top entry is re-evaluated each round.
+# cost_model is a COST_MODELS name or a callable stats_data -> per-source costs.
+# With the unit cost model the order is the same as gen_ap_order.
+def gen_ap_order_lazy(UR, stats_data, cost_model="unit"):
+    cur = compile_ur(UR, stats_data)
 
-        order.append(best_src)
+    if isinstance(cost_model, str):
+        if cost_model not in COST_MODELS:
+            raise ValueError(f"Unknown cost model: {cost_model!r}")
+        cost_model = COST_MODELS[cost_model]
+    costs = cost_model(stats_data)
 
-        for col, covered_vals in best_cover.items():
-            remaining[col] -= covered_vals
+    # candidate source -> UR items it covers
+    src_items = cur.coverage
+    n_items = len(cur.items)
+
+    alive = [True] * n_items
+    n_alive = n_items
+
+    # heap keys: (-score, src) -> best score first, ties to the lowest source id
+    heap = [(-len(items) / costs[src], src) for src, items in src_items.items()]
+    heapq.heapify(heap)
+    order = []
+
+    while heap and n_alive:
+        _, src = heapq.heappop(heap)
+        gain = sum(1 for k in src_items[src] if alive[k])
+        if gain == 0:
+            continue
+
+        key = (-gain / costs[src], src)
+        if heap and key > heap[0]:
+            heapq.heappush(heap, key)  # stale bound was too high, re-queue with the fresh one
+            continue
+
+        order.append(src)
+        for k in src_items[src]:
+            if alive[k]:
+                alive[k] = False
+                n_alive -= 1
 
     return order
 
+
+# Table name of a source in plans and source_order: its source_files entry (without .csv) when the
+# stats have one, else {table_prefix}{src_idx+1}.
+def source_table(src_idx, source_files=None, table_prefix="src"):
+    if source_files:
+        name = source_files[src_idx]
+        return name[:-len(".csv")] if name.endswith(".csv") else name
+    return f"{table_prefix}{src_idx+1}"
+
+
 # Given a UR, an order of sources, and stats data, build a SQL plan that covers the UR. The plan is a list of steps, where each step specifies a source and a SQL query that retrieves the relevant rows from that source.
+# UR can be a dict or a CompiledUR; the per-source hits come from its coverage, so no value lookups happen here.
 def build_sql_plan(UR, order, stats_data, table_prefix="src"):
-        value_index = stats_data["value_index"]
-        source_vectors = stats_data["source_vectors"]
-        
+        cur = compile_ur(UR, stats_data)
+        for col, v in cur.missing:
+            event("missing", col=col, value=v)
+        count("values_missing", len(cur.missing))
 
-        remaining = {c: set(vs) for c, vs in UR.items()}
+        alive = [True] * len(cur.items)
+        n_alive = len(cur.items)
         plan = []
 
         for src_idx in order:
-            vec = source_vectors[src_idx]
-            conditions = []
-            covered_now = {}
-
-            for col, vals in remaining.items():
-                hits = []
-                for v in vals:
-                    j = None
-                    for key in _stats_keys(col, v):
-                        j = value_index.get(key)
-                        if j is not None:
-                            break
-                    if j is None:
+            covered_now = [k for k in cur.coverage.get(src_idx, []) if alive[k]]
+
+            if covered_now:
+                # group hits per UR column, in UR column order
+                hits_by_col = {}
+                for k in covered_now:
+                    col, v = cur.items[k]
+                    hits_by_col.setdefault(col, []).append(v)
+
+                conditions = []
+                for col in cur.ur:
+                    hits = hits_by_col.get(col)
+                    if not hits:
                         continue
-                    if j is not None and vec[j] > 0:
-                        hits.append(v)
-                    if j is None:
-                        print("MISSING:", col, v)
-                   
-
-                if hits:
-                    covered_now[col] = set(hits)
                     hits = sorted(hits, key=str)
-
-                    
                     in_list = ", ".join(_sql_literal(x) for x in hits)
                     conditions.append(f"{col} IN ({in_list})")
 
-            if conditions:
-                source_files = stats_data.get("source_files")
-                if source_files:
-                    tbl = source_files[src_idx]          # use real name 
-                else:
-                    tbl = f"{table_prefix}{src_idx+1}"   # fallback 
-                
+                tbl = source_table(src_idx, stats_data.get("source_files"), table_prefix)
+
                 # sql = f"SELECT * FROM {tbl} WHERE " + " OR ".join(conditions)
                 
                 # In this case, we select only the relevant columns, the ones found in the UR: if the whole result needed, use the commented line above instead.
-                cols = ", ".join(UR.keys())
+                cols = ", ".join(cur.ur.keys())
                 sql = f"SELECT DISTINCT {cols} FROM {tbl} WHERE " + " OR ".join(conditions)
                 plan.append({"src_idx": src_idx, "table": tbl, "sql": sql})
 
-                for col, vs in covered_now.items():
-                    remaining[col] -= vs
+                for k in covered_now:
+                    alive[k] = False
+                n_alive -= len(covered_now)
 
-            if not any(remaining.values()):
+            if not n_alive:
                 break
 
         return plan
+
+
+# Resolve the UR once, order the sources and build the SQL plan from the same CompiledUR.
+# cost_model=None uses gen_ap_order, otherwise gen_ap_order_lazy with that cost model.
+def plan_ap(UR, stats_data, cost_model=None):
+    with span("compile_ur"):
+        cur = compile_ur(UR, stats_data)
+    with span("order", cost_model=cost_model) as sp:
+        if cost_model is None:
+            order = gen_ap_order(cur, stats_data)
+        else:
+            order = gen_ap_order_lazy(cur, stats_data, cost_model=cost_model)
+        sp.set(sources=len(order))
+    with span("build_sql_plan"):
+        plan = build_sql_plan(cur, order, stats_data)
+    count("sources_selected", len(order))
+    return order, plan, cur
     
    
 # Build the payload for the /storeAP endpoint, which includes the original NL query, the parsed UR, the source order, and the generated SQL plan. This will be stored in Neo4j as a PGJSON object.
@@ -143,23 +290,83 @@ def build_storeap_payload(nl_query, UR, order, plan, *, dataset="MATHE", split="
     }
     return {"ap": json.dumps(ap_obj)}
 
-def load_stats(split_path):
+# Files the binary stats artifact is derived from; their (mtime, size) is its fingerprint.
+STATS_INPUT_FILES = ("value_index.json", "stats.npz", "stats.parquet", "source_files.json")
+
+
+def _stats_fingerprint(split_path):
+    fp = {}
+    for fname in STATS_INPUT_FILES:
+        path = os.path.join(split_path, fname)
+        if os.path.exists(path):
+            st = os.stat(path)
+            fp[fname] = [st.st_mtime_ns, st.st_size]
+    return fp
+
+
+# Load stats data (value index, source vectors, postings, source files / sizes) for a split.
+# use_bin=True: mmap the binary artifact in <split>/stats_bin (see sparse_stats.save_stats_bin),
+# building it from the files below on the first load and whenever they change.
+# Otherwise: value_index.json + the sparse stats.npz (CSRMatrix), or the old dense stats.parquet.
+def load_stats(split_path, use_bin=True):
+    bin_dir = os.path.join(split_path, STATS_BIN_DIR)
+    if use_bin:
+        fp = _stats_fingerprint(split_path)
+        meta = read_stats_bin_meta(bin_dir)
+        # no source files at all -> the artifact was shipped on its own
+        if meta is not None and (not fp or meta.get("fingerprint") == fp):
+            return load_stats_bin(bin_dir)
+
+    stats = _load_stats_files(split_path)
+    if use_bin:
+        try:
+            save_stats_bin(
+                bin_dir, stats["source_vectors"], stats["value_index"],
+                source_files=stats["source_files"], source_rows=stats["source_rows"],
+                source_bytes=stats["source_bytes"], numeric_columns=stats["numeric_columns"], fingerprint=fp,
+            )
+        except OSError:
+            pass  # read-only split: keep using the files
+    return stats
+
+
+def _load_stats_files(split_path):
     stats_json = os.path.join(split_path, "value_index.json")
+    stats_npz = os.path.join(split_path, "stats.npz")
     stats_parquet = os.path.join(split_path, "stats.parquet")
     source_files_json = os.path.join(split_path, "source_files.json")  # NEW
 
     with open(stats_json, "r") as f:
-        value_index = json.load(f)
+        value_index = canonicalize_value_index(json.load(f))
+    numeric_cols = numeric_columns(value_index)
+
+    source_rows = source_bytes = None
+    if os.path.exists(stats_npz):
+        source_vectors = load_stats_npz(stats_npz)
+        source_rows, source_bytes = load_source_sizes_npz(stats_npz)
+    else:
+        import pandas as pd  # only the old dense format needs pandas
 
-    df = pd.read_parquet(stats_parquet)
-    source_vectors = df.values
+        df = pd.read_parquet(stats_parquet)
+        source_vectors = df.values
+
+    # inverted value -> sources index used by gen_ap_order
+    postings = build_postings(source_vectors)
 
     source_files = None
     if os.path.exists(source_files_json):
         with open(source_files_json, "r") as f:
             source_files = json.load(f)
 
-    return {"value_index": value_index, "source_vectors": source_vectors, "source_files": source_files}
+    return {
+        "value_index": value_index,
+        "numeric_columns": numeric_cols,
+        "source_vectors": source_vectors,
+        "postings": postings,
+        "source_files": source_files,
+        "source_rows": source_rows,
+        "source_bytes": source_bytes,
+    }
 
 
 
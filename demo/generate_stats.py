@@ -1,18 +1,56 @@
 import os
+import sys
 import json
+import time
+import hashlib
 import numpy as np
 import pandas as pd
 
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
 
-def generate_stats_from_folder(folder, store_stem=True):
-    
-    stats_path = os.path.join(folder, "stats.parquet")
+from demo.sparse_stats import CSRMatrix, load_source_sizes_npz, load_stats_npz, save_stats_npz
+from demo.value_encoding import canon_value, canonicalize_value_index
+
+# per-source fingerprints (size, mtime, sha1) in stats row order, for incremental updates
+MANIFEST_FILE = "stats_manifest.json"
+
+
+def generate_stats_from_folder(folder, store_stem=True, engine="onepass", stats_format="sparse",
+                               force=False, incremental=False, workers=1):
+    """
+    engine:
+      "onepass" -> one value_counts per (source, column), scattered into the vector
+      "legacy"  -> one (df[col] == val).sum() per (source, value index entry)
+    stats_format:
+      "sparse" -> stats.npz (CSR arrays: indptr / indices / data / shape)
+      "dense"  -> stats.parquet (sources x values float32 matrix, old format)
+    force: rebuild even if the stats files already exist
+    incremental: only re-scan the sources that were added or changed since the last
+                 build (see update_stats_incremental); sparse format only
+    workers: > 1 scans the sources in a process pool (map: _scan_source per CSV,
+             reduce: _build_stats_from_scans); onepass engine only, same output as workers=1
+    """
+    if engine not in ("onepass", "legacy"):
+        raise ValueError(f"Unknown stats engine: {engine!r}")
+    if stats_format not in ("sparse", "dense"):
+        raise ValueError(f"Unknown stats format: {stats_format!r}")
+    if workers > 1 and engine != "onepass":
+        raise ValueError("workers > 1 is only supported by the onepass engine")
+    if incremental:
+        if stats_format != "sparse":
+            raise ValueError("incremental stats updates need stats_format='sparse'")
+        return update_stats_incremental(folder, store_stem=store_stem)
+
+    stats_path = os.path.join(folder, "stats.npz" if stats_format == "sparse" else "stats.parquet")
     mapping_path = os.path.join(folder, "value_index.json")
     sources_path = os.path.join(folder, "source_files.json")
 
     # ---- skip if already computed ----
     if (
-        os.path.exists(stats_path)
+        not force
+        and os.path.exists(stats_path)
         and os.path.exists(mapping_path)
         and os.path.exists(sources_path)
     ):
@@ -20,19 +58,37 @@ def generate_stats_from_folder(folder, store_stem=True):
         return None, None
 
     csv_files = sorted([f for f in os.listdir(folder) if f.endswith(".csv")])
-    sources_list = [pd.read_csv(os.path.join(folder, f), low_memory=False) for f in csv_files]
 
-   # Build value index and source vectors
-    value_index = _build_value_index_from_sources(sources_list)
+    if workers > 1:
+        # map-reduce: the workers never send DataFrames back, only per-source value counts
+        from concurrent.futures import ProcessPoolExecutor
 
-    # Compute source vectors using the value index
-    source_vectors = _compute_value_frequencies_from_value_index(sources_list, value_index)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scans = list(pool.map(_scan_source, [os.path.join(folder, f) for f in csv_files]))
+        value_index, source_vectors = _build_stats_from_scans(scans)
+        source_rows = [n_rows for n_rows, _ in scans]
+    else:
+        sources_list = [pd.read_csv(os.path.join(folder, f), low_memory=False) for f in csv_files]
+        source_rows = [len(df) for df in sources_list]
 
-    # Save outputs 
-    stats_path = os.path.join(folder, "stats.parquet")
-    mapping_path = os.path.join(folder, "value_index.json")
+       # Build value index and source vectors
+        value_index = _build_value_index_from_sources(sources_list)
 
-    pd.DataFrame(np.asarray(source_vectors, dtype="float32")).to_parquet(stats_path, index=False)
+        # Compute source vectors using the value index
+        if engine == "onepass":
+            source_vectors = _compute_value_frequencies_onepass(sources_list, value_index)
+        else:
+            source_vectors = _compute_value_frequencies_from_value_index(sources_list, value_index)
+
+    # Save outputs 
+    if stats_format == "sparse":
+        # per-source sizes, used by the planner's cost models
+        source_bytes = [os.path.getsize(os.path.join(folder, f)) for f in csv_files]
+        save_stats_npz(stats_path, source_vectors, source_rows=source_rows, source_bytes=source_bytes)
+    else:
+        if isinstance(source_vectors, CSRMatrix):
+            source_vectors = source_vectors.toarray()
+        pd.DataFrame(np.asarray(source_vectors, dtype="float32")).to_parquet(stats_path, index=False)
 
     value_index_json = {f"{col}:{val}": idx for (col, val), idx in value_index.items()}
     with open(mapping_path, "w") as f:
@@ -43,6 +99,9 @@ def generate_stats_from_folder(folder, store_stem=True):
     with open(os.path.join(folder, "source_files.json"), "w") as f:
         json.dump(source_files, f)
 
+    if stats_format == "sparse":
+        _save_manifest(folder, [_source_entry(folder, f) for f in csv_files])
+
     return value_index, source_vectors
 
 
@@ -53,16 +112,18 @@ def _build_value_index_from_sources(sources_list):
         for col in df.columns:
             if col not in col_to_vals:
                 col_to_vals[col] = set()
-            # dropna + unique, then add to set
+            # dropna + unique, then add the canonical form (80 and 80.0 -> "80"; strings as written)
             for v in df[col].dropna().unique():
-                col_to_vals[col].add(v)
+                cv = canon_value(v)
+                if cv is not None:
+                    col_to_vals[col].add(cv)
 
     # Deterministic ordering
     value_index = {}
     idx = 0
     for col in sorted(col_to_vals.keys()):
-        # sort values deterministically even if mixed types
-        vals_sorted = sorted(col_to_vals[col], key=lambda x: str(x))
+        # canonical values are strings, so the sort is deterministic
+        vals_sorted = sorted(col_to_vals[col])
         for val in vals_sorted:
             value_index[(col, val)] = idx
             idx += 1
@@ -74,7 +135,7 @@ def _compute_value_frequencies_from_value_index(sources_list, value_index):
     """
     Same semantics as your original code:
       for each source df:
-        vector[i] = count(df[col] == val) / n_rows
+        vector[i] = count(canon(df[col]) == val) / n_rows
     """
     vector_length = len(value_index)
     source_vectors = []
@@ -84,38 +145,304 @@ def _compute_value_frequencies_from_value_index(sources_list, value_index):
         vector = np.zeros(vector_length, dtype=np.float32)
         n_rows = len(df)
         if n_rows > 0:
+            canon_cols = {col: df[col].map(canon_value) for col in df.columns}
             for (col, val), i in value_index.items():
-                if col in df.columns:
-                    count = (df[col] == val).sum()
+                if col in canon_cols:
+                    count = (canon_cols[col] == val).sum()
                     vector[i] = count / n_rows
         source_vectors.append(vector)
 
     return np.array(source_vectors, dtype=np.float32)
 
+
+def _compute_value_frequencies_onepass(sources_list, value_index):
+    """
+    Same values as _compute_value_frequencies_from_value_index, but each
+    source column is scanned once:
+      counts = df[col].value_counts()  -> scattered into vector[value_index[(col, canon(val))]]
+    Distinct values with the same canonical form (e.g. 2 and "2") are summed.
+    Returns a CSRMatrix (only the non-zero entries of each vector are kept).
+    """
+    # col -> {val: idx}
+    col_lookup = {}
+    for (col, val), i in value_index.items():
+        col_lookup.setdefault(col, {})[val] = i
+
+    row_nnz = []
+    all_indices = []
+    all_data = []
+
+    for df in sources_list:
+        n_rows = len(df)
+        row_idx = []
+        row_val = []
+        if n_rows > 0:
+            for col in df.columns:
+                lookup = col_lookup.get(col)
+                if not lookup:
+                    continue
+                vc = df[col].value_counts(dropna=True, sort=False)
+                idx = np.fromiter((lookup.get(canon_value(v), -1) for v in vc.index), dtype=np.int64, count=len(vc))
+                hit = idx >= 0
+                row_idx.append(idx[hit])
+                row_val.append(vc.to_numpy(dtype=np.float64)[hit])
+
+        idx = np.concatenate(row_idx) if row_idx else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(row_val) if row_val else np.zeros(0, dtype=np.float64)
+        # merge entries that share a canonical value; np.unique also sorts the indices
+        uniq, inv = np.unique(idx, return_inverse=True)
+        counts = np.bincount(inv, weights=counts, minlength=len(uniq))
+        all_indices.append(uniq)
+        all_data.append((counts / n_rows).astype(np.float32) if n_rows else counts.astype(np.float32))
+        row_nnz.append(len(uniq))
+
+    indptr = np.zeros(len(sources_list) + 1, dtype=np.int64)
+    np.cumsum(row_nnz, out=indptr[1:])
+    indices = np.concatenate(all_indices) if all_indices else np.zeros(0, dtype=np.int64)
+    data = np.concatenate(all_data) if all_data else np.zeros(0, dtype=np.float32)
+    return CSRMatrix(indptr, indices, data, (len(sources_list), len(value_index)))
+
+
+# Reduce step of the parallel build: value index and CSR matrix from the per-source scans,
+# numbered exactly like _build_value_index_from_sources (columns sorted, then canonical values).
+def _build_stats_from_scans(scans):
+    col_to_vals = {}
+    for _, counts in scans:
+        for col, val in counts:
+            col_to_vals.setdefault(col, set()).add(val)
+
+    value_index = {}
+    for col in sorted(col_to_vals):
+        for val in sorted(col_to_vals[col]):
+            value_index[(col, val)] = len(value_index)
+
+    rows = [_csr_row(n_rows, counts, value_index) for n_rows, counts in scans]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(idx) for idx, _ in rows], out=indptr[1:])
+    matrix = CSRMatrix(
+        indptr,
+        np.concatenate([idx for idx, _ in rows]) if rows else np.zeros(0, dtype=np.int64),
+        np.concatenate([data for _, data in rows]) if rows else np.zeros(0, dtype=np.float32),
+        (len(rows), len(value_index)),
+    )
+    return value_index, matrix
+
+
+# ---- incremental updates ----
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _source_entry(folder, fname, sha1=None):
+    st = os.stat(os.path.join(folder, fname))
+    return {
+        "file": fname,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha1": sha1 or _file_sha1(os.path.join(folder, fname)),
+    }
+
+
+def _load_manifest(folder):
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["sources"]
+
+
+def _save_manifest(folder, entries):
+    with open(os.path.join(folder, MANIFEST_FILE), "w") as f:
+        json.dump({"sources": entries}, f)
+
+
+# One source -> (n_rows, {(col, canonical value): count}); distinct values with the same
+# canonical form are summed, as in _compute_value_frequencies_onepass.
+def _scan_source(path):
+    df = pd.read_csv(path, low_memory=False)
+    counts = {}
+    for col in df.columns:
+        vc = df[col].value_counts(dropna=True, sort=False)
+        for v, c in zip(vc.index, vc.to_numpy()):
+            cv = canon_value(v)
+            if cv is not None:
+                counts[(col, cv)] = counts.get((col, cv), 0) + int(c)
+    return len(df), counts
+
+
+# CSR row (sorted value ids, frequencies) of a scanned source.
+def _csr_row(n_rows, counts, value_index):
+    if not n_rows or not counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    idx = np.fromiter((value_index[key] for key in counts), dtype=np.int64, count=len(counts))
+    freq = np.fromiter(counts.values(), dtype=np.float64, count=len(counts)) / n_rows
+    order = np.argsort(idx)
+    return idx[order], freq[order].astype(np.float32)
+
+
+def update_stats_incremental(folder, store_stem=True):
+    """
+    Bring stats.npz / value_index.json / source_files.json up to date with the CSVs,
+    re-reading only the sources that changed since the last build.
+    A source counts as changed when its size or mtime differ from stats_manifest.json
+    and its sha1 differs too (a plain touch is not a change).
+      - changed sources : their matrix row is recomputed in place
+      - new sources     : appended as new rows (sorted by file name)
+      - removed sources : their row is dropped (later source ids shift down by one)
+    Values seen for the first time get new ids after the existing ones; existing ids are
+    never renumbered, and values no longer present anywhere keep their (now empty) column.
+    Falls back to a full build when there is no manifest yet.
+    Returns a summary dict.
+    """
+    npz_path = os.path.join(folder, "stats.npz")
+    mapping_path = os.path.join(folder, "value_index.json")
+    sources_path = os.path.join(folder, "source_files.json")
+
+    manifest = _load_manifest(folder)
+    if manifest is None or not all(os.path.exists(p) for p in (npz_path, mapping_path, sources_path)):
+        generate_stats_from_folder(folder, store_stem=store_stem, force=True)
+        return {"mode": "full"}
+
+    csv_files = sorted(f for f in os.listdir(folder) if f.endswith(".csv"))
+    present = set(csv_files)
+    known = {e["file"] for e in manifest}
+
+    kept, changed, removed = [], [], []
+    for row, entry in enumerate(manifest):
+        fname = entry["file"]
+        if fname not in present:
+            removed.append(fname)
+            continue
+        st = os.stat(os.path.join(folder, fname))
+        if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+            kept.append((row, entry, False))
+            continue
+        sha1 = _file_sha1(os.path.join(folder, fname))
+        is_changed = sha1 != entry["sha1"]
+        if is_changed:
+            changed.append(fname)
+        kept.append((row, _source_entry(folder, fname, sha1), is_changed))
+    added = [f for f in csv_files if f not in known]
+
+    summary = {"mode": "incremental", "added": added, "changed": changed, "removed": removed, "new_values": 0}
+    if not (added or changed or removed):
+        # at most mtimes moved; remember them so the next check is a plain stat again
+        _save_manifest(folder, [entry for _, entry, _ in kept])
+        return summary
+
+    # re-scan only what changed
+    scans = {f: _scan_source(os.path.join(folder, f)) for f in changed + added}
+
+    with open(mapping_path, "r") as f:
+        value_index = {}
+        for key, j in canonicalize_value_index(json.load(f)).items():
+            col, _, val = key.partition(":")
+            value_index[(col, val)] = j
+    new_keys = sorted({key for _, counts in scans.values() for key in counts} - value_index.keys())
+    next_id = len(value_index)
+    for key in new_keys:
+        value_index[key] = next_id
+        next_id += 1
+    summary["new_values"] = len(new_keys)
+
+    old = load_stats_npz(npz_path)
+    old_rows, old_bytes = load_source_sizes_npz(npz_path)
+
+    rows_idx, rows_data, source_rows, source_bytes, entries = [], [], [], [], []
+    for row, entry, is_changed in kept:
+        if is_changed:
+            n_rows, counts = scans[entry["file"]]
+            idx, data = _csr_row(n_rows, counts, value_index)
+        else:
+            idx, data = old.row_indices(row), old.row_data(row)
+            n_rows = int(old_rows[row]) if old_rows is not None else None
+        rows_idx.append(idx)
+        rows_data.append(data)
+        source_rows.append(n_rows)
+        source_bytes.append(entry["size"])
+        entries.append(entry)
+    for fname in added:
+        n_rows, counts = scans[fname]
+        idx, data = _csr_row(n_rows, counts, value_index)
+        rows_idx.append(idx)
+        rows_data.append(data)
+        source_rows.append(n_rows)
+        entry = _source_entry(folder, fname)
+        source_bytes.append(entry["size"])
+        entries.append(entry)
+
+    indptr = np.zeros(len(rows_idx) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in rows_idx], out=indptr[1:])
+    matrix = CSRMatrix(
+        indptr,
+        np.concatenate(rows_idx) if rows_idx else np.zeros(0, dtype=np.int64),
+        np.concatenate(rows_data) if rows_data else np.zeros(0, dtype=np.float32),
+        (len(rows_idx), len(value_index)),
+    )
+    if any(r is None for r in source_rows):
+        source_rows = None  # stats.npz predates source sizes; keep it without them
+    save_stats_npz(npz_path, matrix, source_rows=source_rows, source_bytes=source_bytes)
+
+    with open(mapping_path, "w") as f:
+        json.dump({f"{col}:{val}": idx for (col, val), idx in value_index.items()}, f)
+    with open(sources_path, "w") as f:
+        json.dump([os.path.splitext(e["file"])[0] if store_stem else e["file"] for e in entries], f)
+    _save_manifest(folder, entries)
+    return summary
+
+
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate source stats / value_index.json for a split folder.")
+    parser.add_argument("folder", nargs="?", default="data/MATHE_random_100")
+    parser.add_argument("--engine", choices=["onepass", "legacy"], default="onepass")
+    parser.add_argument("--format", dest="stats_format", choices=["sparse", "dense"], default="sparse")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the stats files exist")
+    parser.add_argument("--incremental", action="store_true", help="only re-scan added / changed sources")
+    parser.add_argument("--workers", type=int, default=1, help="scan the sources in N processes (onepass only)")
+    args = parser.parse_args()
+    folder = args.folder
 
-    folder = "/Users/faresa/Desktop/tvd-ap-demo/data/MATHE_random_100" 
+    if args.incremental:
+        t0 = time.perf_counter()
+        summary = update_stats_incremental(folder)
+        print(f"=== INCREMENTAL UPDATE ({time.perf_counter() - t0:.2f}s) ===")
+        for key, val in summary.items():
+            print(f"{key:<11}: {val}")
+        return
 
     print("\n=== GENERATING STATS ===")
-    value_index, vectors = generate_stats_from_folder(folder)
+    t0 = time.perf_counter()
+    value_index, vectors = generate_stats_from_folder(
+        folder, engine=args.engine, stats_format=args.stats_format, force=args.force, workers=args.workers
+    )
+    if vectors is None:
+        return
+    print(f"Engine            : {args.engine} ({time.perf_counter() - t0:.2f}s)")
 
     print("\n=== DONE ===")
     print(f"Number of sources : {len(vectors)}")
     print(f"Vector size       : {len(value_index)}")
 
     # quick verification
-    stats_file = os.path.join(folder, "stats.parquet")
+    stats_file = os.path.join(folder, "stats.npz" if args.stats_format == "sparse" else "stats.parquet")
     mapping_file = os.path.join(folder, "value_index.json")
     sources_file = os.path.join(folder, "source_files.json")
 
     print("\nGenerated files:")
-    print(stats_file)
+    print(stats_file, f"({os.path.getsize(stats_file) / 1e6:.2f} MB)")
     print(mapping_file)
     print(sources_file)
 
-    df = pd.read_parquet(stats_file)
-    print("\nStats shape:", df.shape)
+    from demo.gen_ap import load_stats
+    print("\nStats shape:", load_stats(folder)["source_vectors"].shape)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
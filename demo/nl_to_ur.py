@@ -1,10 +1,25 @@
 import re
 import json
+import os
+import sys
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.trace import count, span
+
+_PUNCT_RE = re.compile(r"[^a-z0-9\s]")
+_WS_RE = re.compile(r"\s+")
 
 def _norm(s: str) -> str:
     s = s.lower().strip()
-    s = re.sub(r"[^a-z0-9\s]", " ", s)  # remove punctuation
-    s = re.sub(r"\s+", " ", s)
+    s = _PUNCT_RE.sub(" ", s)  # remove punctuation
+    s = _WS_RE.sub(" ", s)
 
     words = s.split()
     words = [w for w in words if w not in STOPWORDS]
@@ -46,58 +61,209 @@ def expand_synonyms(text: str) -> str:
 
 
 
-def parse_nl_to_ur(text: str, lexicon: dict) -> dict:
-    t = expand_synonyms(_norm(text))
-    raw = re.sub(r"\s+", " ", text.lower().strip())
-    ur = {}
-
-    # topic / subtopic / keyword (auto-match)
-    t = expand_synonyms(_norm(text))
-    t_tokens = set(t.split())
-
-    for attr in ["topic_name", "subtopic_name", "keyword_name"]:
-        phrases = lexicon.get(attr, [])
-        matched = []
-        for p in phrases:
-            p_exp = expand_synonyms(_norm(p))
-            if set(p_exp.split()).issubset(t_tokens):
-                matched.append(p)
-        if matched:
-            ur[attr] = list(dict.fromkeys(matched))
-
-    # levels -> newLevel
-    levels = []
-    for pat in LEVEL_PATTERNS:
-        levels += [int(x) for x in re.findall(pat, raw)]
-    if levels:
-        ur["newLevel"] = sorted(set(levels))
-
-    # question_id
-    qids = []
-    for pat in QUESTION_PATTERNS:
-        qids += [int(x) for x in re.findall(pat, raw)]
-    if qids:
-        ur["question_id"] = sorted(set(qids))
-
-    # answer1 (ONLY if explicitly mentioned)
-    m = re.search(ANSWER_PATTERN, raw)
-    if m:
-        answer_text = _norm(m.group(1).strip())
-        # match against lexicon values
-        answers = lexicon.get("answer1", [])
-        matched_answers = [
-            a for a in answers if _norm(a) == answer_text
-        ]
-        if matched_answers:
-            ur["answer1"] = matched_answers
+# Lexicon phrases for topic / subtopic / keyword, compiled once into an inverted
+# token -> phrase index (and a token trie for contiguous matching), so matching a query
+# costs about its length instead of the lexicon size.
+#   mode="subset"     -> every token of the phrase appears somewhere in the query (original rule)
+#   mode="contiguous" -> the phrase tokens appear in order, next to each other
+class LexiconMatcher:
+    ATTRS = ("topic_name", "subtopic_name", "keyword_name")
+
+    def __init__(self, lexicon, attrs=ATTRS):
+        self.lexicon = lexicon
+        self.attrs = tuple(attrs)
+        self.phrases = {}       # attr -> [phrase]
+        self.n_tokens = {}      # attr -> [number of distinct tokens of phrase i]
+        self.index = {}         # attr -> {token: [phrase ids]}
+        self.always = {}        # attr -> phrase ids with no tokens (they match any query)
+        self.trie = {}          # attr -> nested {token: {...}}, phrase ids under key None
+
+        for attr in self.attrs:
+            phrases = lexicon.get(attr, [])
+            index, always, n_tokens, trie = {}, [], [], {}
+            for i, p in enumerate(phrases):
+                seq = expand_synonyms(_norm(p)).split()
+                toks = set(seq)
+                n_tokens.append(len(toks))
+                if not toks:
+                    always.append(i)
+                for tok in toks:
+                    index.setdefault(tok, []).append(i)
+                node = trie
+                for tok in seq:
+                    node = node.setdefault(tok, {})
+                node.setdefault(None, []).append(i)
+            self.phrases[attr] = phrases
+            self.n_tokens[attr] = n_tokens
+            self.index[attr] = index
+            self.always[attr] = always
+            self.trie[attr] = trie
+
+    def match(self, tokens, attr, mode="subset"):
+        """tokens: normalized, synonym-expanded query tokens (in order). Returns phrases in lexicon order."""
+        if mode == "subset":
+            hits = {}
+            index = self.index[attr]
+            for tok in set(tokens):
+                for i in index.get(tok, ()):
+                    hits[i] = hits.get(i, 0) + 1
+            n_tokens = self.n_tokens[attr]
+            ids = [i for i, h in hits.items() if h == n_tokens[i]]
+            ids.extend(self.always[attr])
+        elif mode == "contiguous":
+            ids = list(self.always[attr])
+            root = self.trie[attr]
+            for start in range(len(tokens)):
+                node = root
+                for tok in tokens[start:]:
+                    node = node.get(tok)
+                    if node is None:
+                        break
+                    ids.extend(node.get(None, ()))
+        else:
+            raise ValueError(f"Unknown match mode: {mode!r}")
+
+        phrases = self.phrases[attr]
+        return list(dict.fromkeys(phrases[i] for i in sorted(set(ids))))
+
+
+# Everything parse_nl_to_ur needs, built once from lexicon.json:
+#   - the LexiconMatcher phrase index / trie
+#   - LEVEL_PATTERNS / QUESTION_PATTERNS as one precompiled alternation each
+#   - answer1 values grouped by their normalized text
+# It holds no reference to the lexicon dict, so it pickles small (see load_compiled_lexicon).
+class CompiledLexicon(LexiconMatcher):
+    def __init__(self, lexicon, attrs=LexiconMatcher.ATTRS):
+        super().__init__(lexicon, attrs)
+        self.lexicon = None
+        self.answers = {}
+        for a in lexicon.get("answer1", []):
+            self.answers.setdefault(_norm(a), []).append(a)
+        self._compile_patterns()
+
+    def _compile_patterns(self):
+        self.level_re = re.compile("|".join(f"(?:{p})" for p in LEVEL_PATTERNS))
+        self.question_re = re.compile("|".join(f"(?:{p})" for p in QUESTION_PATTERNS))
+        self.answer_re = re.compile(ANSWER_PATTERN)
+
+    # plain-data state for the on-disk artifact (no class or regex objects in the pickle)
+    _STATE_FIELDS = ("attrs", "phrases", "n_tokens", "index", "always", "trie", "answers")
+
+    def to_state(self):
+        return {k: getattr(self, k) for k in self._STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state):
+        obj = cls.__new__(cls)
+        for k in cls._STATE_FIELDS:
+            setattr(obj, k, state[k])
+        obj.lexicon = None
+        obj._compile_patterns()
+        return obj
+
+    @staticmethod
+    def _numbers(pattern, raw):
+        return [int(m.group(m.lastindex)) for m in pattern.finditer(raw)]
+
+    def parse(self, text: str, mode: str = "subset") -> dict:
+        raw = _WS_RE.sub(" ", text.lower().strip())
+        ur = {}
+
+        # topic / subtopic / keyword (auto-match)
+        t_seq = expand_synonyms(_norm(text)).split()
+        for attr in self.attrs:
+            matched = self.match(t_seq, attr, mode=mode)
+            if matched:
+                ur[attr] = matched
+
+        # levels -> newLevel
+        levels = self._numbers(self.level_re, raw)
+        if levels:
+            ur["newLevel"] = sorted(set(levels))
+
+        # question_id
+        qids = self._numbers(self.question_re, raw)
+        if qids:
+            ur["question_id"] = sorted(set(qids))
+
+        # answer1 (ONLY if explicitly mentioned)
+        m = self.answer_re.search(raw)
+        if m:
+            matched_answers = self.answers.get(_norm(m.group(1).strip()))
+            if matched_answers:
+                ur["answer1"] = list(matched_answers)
+
+        return ur
+
+
+# id(lexicon dict) -> (dict, CompiledLexicon), least recently used first. Bounded, so a long-running
+# process that keeps building new lexicon dicts does not keep every one of them alive.
+_COMPILED_CACHE = OrderedDict()
+_COMPILED_CACHE_SIZE = 8
+_COMPILED_LOCK = threading.Lock()
+
+
+# CompiledLexicon for a lexicon dict, built on first use and reused while the same dict object is passed.
+def compile_lexicon(lexicon):
+    if isinstance(lexicon, CompiledLexicon):
+        return lexicon
+    with _COMPILED_LOCK:
+        cached = _COMPILED_CACHE.get(id(lexicon))
+        if cached is not None and cached[0] is lexicon:
+            _COMPILED_CACHE.move_to_end(id(lexicon))
+            return cached[1]
+    compiled = CompiledLexicon(lexicon)
+    with _COMPILED_LOCK:
+        _COMPILED_CACHE[id(lexicon)] = (lexicon, compiled)
+        _COMPILED_CACHE.move_to_end(id(lexicon))
+        while len(_COMPILED_CACHE) > _COMPILED_CACHE_SIZE:
+            _COMPILED_CACHE.popitem(last=False)
+    return compiled
+
+
+_ARTIFACT_VERSION = 1
+
+
+# Load lexicon.json as a CompiledLexicon, through a pickle artifact next to it
+# (lexicon.compiled.pkl). The artifact is rebuilt when lexicon.json's content changes.
+def load_compiled_lexicon(lexicon_path, artifact_path=None):
+    artifact_path = artifact_path or os.path.splitext(lexicon_path)[0] + ".compiled.pkl"
+    with open(lexicon_path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+
+    if os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, "rb") as f:
+                art = pickle.load(f)
+            if art.get("version") == _ARTIFACT_VERSION and art.get("sha1") == digest:
+                return CompiledLexicon.from_state(art["state"])
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError):
+            pass
+
+    compiled = CompiledLexicon(json.loads(raw))
+    try:
+        with open(artifact_path, "wb") as f:
+            pickle.dump({"version": _ARTIFACT_VERSION, "sha1": digest, "state": compiled.to_state()}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # read-only checkout: just use the in-memory one
+    return compiled
+
 
+# lexicon: the lexicon dict or a CompiledLexicon
+def parse_nl_to_ur(text: str, lexicon, mode: str = "subset") -> dict:
+    with span("parse", mode=mode) as sp:
+        ur = compile_lexicon(lexicon).parse(text, mode=mode)
+        n_values = sum(len(v) for v in ur.values())
+        sp.set(ur_values=n_values)
+        count("ur_values", n_values)
     return ur
 
 
 # ---- RUN ----
 if __name__ == "__main__":
-    with open("demo/lexicon.json") as f:
-        LEXICON = json.load(f)
+    LEXICON = load_compiled_lexicon("demo/lexicon.json")
 
     query = "How can I solve a linear system 4x4?"
     ur = parse_nl_to_ur(query, LEXICON)
@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.ap_store import open_ap_store
+from demo.cache import PipelineCache, plan_hash, ur_key
+from demo.execute_ap import execute_ap, execute_ap_pruned, open_split_connection
+from demo.gen_ap import source_table
+from demo.nl_to_ur import load_compiled_lexicon
+from demo.trace import Tracer
+from demo.utils import EPrune
+
+LEXICON_PATH = os.path.join(PROJECT_ROOT, "demo", "lexicon.json")
+
+# Long-running planning / execution service (stdlib asyncio HTTP, JSON in and out).
+#   POST /parse    {"nl", "mode"?}                          -> {"ur"}
+#   POST /plan     {"ur" | "nl", "cost_model"?}             -> {"ur", "order", "source_order", "sql_plan", "missing"}
+#   POST /execute  {"plan" | "ur" | "nl", "mode"?}          -> {"columns", "data", "n_rows"}
+#   POST /prune    {"ur", "plan"?, "engine"?: duckdb|eprune} -> {"columns", "data", "n_rows"}
+#   POST /storeAP  build_storeap_payload(...) or an AP dict -> {"id"}
+#   POST /findAP   {"ur" | "nl", "exact"?, "limit"?}        -> {"aps"} stored APs covering the UR
+#   GET  /health, GET /stats
+# Any POST body may add "trace": true to get the span timings and counters back under "trace".
+# Lexicon, stats (through PipelineCache) and one DuckDB connection with every source attached
+# stay warm in the process; blocking work runs on a thread pool, and identical requests that
+# arrive while one is in flight share its result.
+
+
+def _json_default(v):
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.floating):
+        return float(v)
+    if isinstance(v, np.bool_):
+        return bool(v)
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    return str(v)
+
+
+# Request bodies come from clients: reject what the planner would misread (a bare string is
+# iterated as its characters, a dict as its keys) instead of planning it.
+def _check_ur(ur):
+    if not isinstance(ur, dict):
+        raise ValueError("'ur' must be an object {column: [values]}")
+    for col, vals in ur.items():
+        if not isinstance(vals, list):
+            raise ValueError(f"'ur'[{col!r}] must be a list of values, got {type(vals).__name__}")
+        if any(isinstance(v, (list, dict)) for v in vals):
+            raise ValueError(f"'ur'[{col!r}] must hold scalar values")
+    return ur
+
+
+def _check_plan(plan):
+    if not isinstance(plan, list) or not all(
+        isinstance(step, dict) and isinstance(step.get("table"), str) and isinstance(step.get("sql"), str)
+        for step in plan
+    ):
+        raise ValueError("'plan' must be a list of {\"table\", \"sql\"} steps")
+    return plan
+
+
+def _frame_payload(df):
+    out = json.loads(df.to_json(orient="split", index=False, date_format="iso"))
+    return {"columns": out["columns"], "data": out["data"], "n_rows": len(df)}
+
+
+class PipelineService:
+    def __init__(self, split_path, lexicon_path=LEXICON_PATH, store_path=None, workers=4, use_db=True,
+                 max_results=256, max_result_bytes=256 * 2**20):
+        self.split_path = split_path
+        self.use_db = use_db
+        self.lexicon = load_compiled_lexicon(lexicon_path)
+        self.cache = PipelineCache(split_path, max_results=max_results, max_result_bytes=max_result_bytes)
+        self.store = open_ap_store(store_path or os.path.join(split_path, "ap_store.sqlite"))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.counters = {"requests": 0, "coalesced": 0, "errors": 0}
+        self._lock = threading.Lock()  # PipelineCache and the warm connection
+        self._con = None  # [connection, split fingerprint, users, retired]
+        self._inflight = {}
+        self.handlers = {
+            "/parse": self.parse,
+            "/plan": self.plan,
+            "/execute": self.execute,
+            "/prune": self.prune,
+            "/storeAP": self.store_ap,
+            "/findAP": self.find_ap,
+        }
+
+    # ---- warm state ----
+    def _stats(self):
+        with self._lock:
+            return self.cache.stats_data()
+
+    # The shared connection, reopened (and the split re-ingested) when the split changed.
+    # Yields (connection, stats, fingerprint). A replaced connection is closed only once the
+    # last request using it is done, so a split change never pulls it from under a query.
+    @contextlib.contextmanager
+    def _connection(self):
+        with self._lock:
+            stats = self.cache.stats_data()
+            fp = self.cache._fingerprint
+            if self._con is None or fp != self._con[1]:
+                if self._con is not None:
+                    self._retire(self._con)
+                self._con = [open_split_connection(self.split_path, stats.get("source_files"), self.use_db), fp, 0, False]
+            entry = self._con
+            entry[2] += 1
+        try:
+            yield entry[0], stats, fp
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                if entry[3] and entry[2] == 0:
+                    entry[0].close()
+
+    # no new users for this connection; closed now if idle, else by its last user (lock held)
+    def _retire(self, entry):
+        entry[3] = True
+        if entry[2] == 0:
+            entry[0].close()
+
+    def warm_up(self):
+        with self._connection():
+            pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            if self._con is not None:
+                self._retire(self._con)
+                self._con = None
+        self.store.close()
+
+    # ---- blocking handlers (run on the executor) ----
+    def parse(self, body):
+        if "nl" not in body:
+            raise ValueError("'nl' is required")
+        return {"ur": self.lexicon.parse(body["nl"], mode=body.get("mode", "subset"))}
+
+    def _ur(self, body):
+        if body.get("ur") is not None:
+            return _check_ur(body["ur"])
+        if "nl" in body:
+            return self.parse(body)["ur"]
+        raise ValueError("'ur' or 'nl' is required")
+
+    def plan(self, body):
+        ur = self._ur(body)
+        with self._lock:
+            order, plan, cur = self.cache.plan(ur, cost_model=body.get("cost_model"))
+            source_files = self.cache.stats_data().get("source_files")
+        return {
+            "ur": ur,
+            "order": order,
+            "source_order": [source_table(i, source_files) for i in order],
+            "sql_plan": plan,
+            "missing": [[col, v] for col, v in cur.missing],
+        }
+
+    def _cached_result(self, key, compute):
+        with self._lock:
+            hit = self.cache.results.get(key)
+        if hit is None:
+            hit = compute()
+            with self._lock:
+                self.cache.results.put(key, hit)
+        return hit
+
+    def execute(self, body):
+        plan = _check_plan(body["plan"]) if body.get("plan") is not None else self.plan(body)["sql_plan"]
+        mode = body.get("mode", "steps")
+        with self._connection() as (con, stats, fp):
+            key = (fp, "execute", plan_hash(plan), mode)
+            return self._cached_result(key, lambda: _frame_payload(
+                execute_ap(plan, self.split_path, source_files=stats.get("source_files"), use_db=self.use_db,
+                           mode=mode, con=con)
+            ))
+
+    def prune(self, body):
+        ur = self._ur(body)
+        plan = _check_plan(body["plan"]) if body.get("plan") is not None else self.plan(body)["sql_plan"]
+        engine = body.get("engine", "duckdb")
+        if engine not in ("duckdb", "eprune"):
+            raise ValueError(f"Unknown prune engine: {engine!r}")
+        with self._connection() as (con, stats, fp):
+            source_files = stats.get("source_files")
+
+            def compute():
+                if engine == "duckdb":
+                    df = execute_ap_pruned(plan, ur, self.split_path, source_files=source_files, use_db=self.use_db, con=con)
+                else:
+                    df = EPrune(execute_ap(plan, self.split_path, source_files=source_files, use_db=self.use_db, con=con), ur)
+                return _frame_payload(df)
+
+            key = (fp, "prune", plan_hash(plan), ur_key(ur), engine)
+            return self._cached_result(key, compute)
+
+    def store_ap(self, body):
+        return {"id": self.store.store(body)}
+
+    # stored APs whose UR covers this one (or has the same items with "exact": true), tightest first
+    def find_ap(self, body):
+        if not hasattr(self.store, "find_covering"):
+            raise ValueError("/findAP needs a SQLite AP store")
+        ur = self._ur(body)
+        if body.get("exact"):
+            return {"aps": self.store.find_exact(ur)[: body.get("limit", 10)]}
+        return {"aps": self.store.find_covering(ur, limit=body.get("limit", 10))}
+
+    def stats(self):
+        return {**self.counters, "inflight": len(self._inflight), "stored_aps": len(self.store), "cache": self.cache.stats()}
+
+    # ---- async layer ----
+    def _run(self, handler, body):
+        if not body.get("trace"):
+            return handler(body)
+        with Tracer(handler.__name__) as tr:
+            out = handler(body)
+        return {**out, "trace": {"spans": tr.summary(), "counters": tr.counters}}
+
+    async def call(self, endpoint, body):
+        handler = self.handlers.get(endpoint)
+        if handler is None:
+            raise KeyError(endpoint)
+        self.counters["requests"] += 1
+        loop = asyncio.get_running_loop()
+        if endpoint == "/storeAP":  # every store is a new record, never coalesced
+            return await loop.run_in_executor(self.executor, self._run, handler, body)
+
+        key = hashlib.sha1((endpoint + "\0" + json.dumps(body, sort_keys=True, default=_json_default)).encode()).hexdigest()
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(fut)
+        fut = loop.run_in_executor(self.executor, self._run, handler, body)
+        self._inflight[key] = fut
+        try:
+            return await asyncio.shield(fut)
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    async def dispatch(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method != "POST" or path not in self.handlers:
+            return 404, {"error": f"no route {method} {path}"}
+        try:
+            payload = json.loads(body or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("request body must be a JSON object")
+            return 200, await self.call(path, payload)
+        except (ValueError, KeyError, TypeError) as e:
+            self.counters["errors"] += 1
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:  # keep serving; report the failure to the client
+            self.counters["errors"] += 1
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+
+# ---- minimal HTTP/1.1 over asyncio streams ----
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+async def _handle_connection(service, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length else b""
+
+            status, payload = await service.dispatch(method, target.split("?", 1)[0], body)
+            data = json.dumps(payload, default=_json_default).encode()
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass  # malformed request or client went away
+    finally:
+        writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=8765):
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    await loop.run_in_executor(service.executor, service.warm_up)
+    server = await asyncio.start_server(lambda r, w: _handle_connection(service, r, w), host, port)
+    print(f"serving {service.split_path} on http://{host}:{port} (warm-up {time.perf_counter() - t0:.2f}s)", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+# ---- client ----
+# Thin JSON client for the service (stdlib only), used by the UI when TVD_SERVICE_URL is set.
+class ServiceClient:
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body, default=_json_default).encode()
+        req = urllib.request.Request(self.base_url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", str(e))
+            except ValueError:
+                message = str(e)
+            raise RuntimeError(f"{path}: {message}") from None
+
+    @staticmethod
+    def _frame(payload):
+        import pandas as pd
+
+        return pd.DataFrame(payload["data"], columns=payload["columns"])
+
+    def health(self):
+        return self._request("/health")
+
+    def stats(self):
+        return self._request("/stats")
+
+    def parse(self, nl, mode="subset"):
+        return self._request("/parse", {"nl": nl, "mode": mode})["ur"]
+
+    def plan(self, ur, cost_model=None):
+        return self._request("/plan", {"ur": ur, "cost_model": cost_model})
+
+    def execute(self, plan, mode="steps"):
+        return self._frame(self._request("/execute", {"plan": plan, "mode": mode}))
+
+    def prune(self, plan, ur, engine="duckdb"):
+        return self._frame(self._request("/prune", {"plan": plan, "ur": ur, "engine": engine}))
+
+    # payload: build_storeap_payload(...) output or an AP dict
+    def store_ap(self, payload):
+        return self._request("/storeAP", payload)["id"]
+
+    def find_ap(self, ur, exact=False, limit=10):
+        return self._request("/findAP", {"ur": ur, "exact": exact, "limit": limit})["aps"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planning / execution service with warm state.")
+    parser.add_argument("split", nargs="?", default=os.path.join(PROJECT_ROOT, "data", "MATHE_random_100"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--lexicon", default=LEXICON_PATH)
+    parser.add_argument("--store", default=None, help="AP store: SQLite file, or a .jsonl file (default: <split>/ap_store.sqlite)")
+    parser.add_argument("--workers", type=int, default=4, help="threads for the blocking work")
+    parser.add_argument("--no-db", action="store_true", help="read the CSVs directly instead of split.duckdb")
+    args = parser.parse_args()
+
+    service = PipelineService(args.split, lexicon_path=args.lexicon, store_path=args.store,
+                              workers=args.workers, use_db=not args.no_db)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
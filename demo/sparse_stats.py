@@ -0,0 +1,320 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+
+# Minimal CSR container for the source x value matrix (rows = sources, cols = value index).
+# Only what the planner needs, so we do not pull scipy in as a dependency.
+class CSRMatrix:
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float32)
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    @classmethod
+    def from_dense(cls, dense):
+        dense = np.asarray(dense, dtype=np.float32)
+        rows, cols = np.nonzero(dense)
+        indptr = np.zeros(dense.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=dense.shape[0]), out=indptr[1:])
+        return cls(indptr, cols, dense[rows, cols], dense.shape)
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    def row_indices(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def row_data(self, i):
+        return self.data[self.indptr[i]:self.indptr[i + 1]]
+
+    def __getitem__(self, i):
+        # dense row, so existing code doing vec[j] keeps working
+        row = np.zeros(self.shape[1], dtype=np.float32)
+        row[self.row_indices(i)] = self.row_data(i)
+        return row
+
+    def __len__(self):
+        return self.shape[0]
+
+    def toarray(self):
+        out = np.zeros(self.shape, dtype=np.float32)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        out[rows, self.indices] = self.data
+        return out
+
+
+def save_stats_npz(path, source_vectors, source_rows=None, source_bytes=None):
+    if not isinstance(source_vectors, CSRMatrix):
+        source_vectors = CSRMatrix.from_dense(source_vectors)
+    extra = {}
+    if source_rows is not None:
+        extra["source_rows"] = np.asarray(source_rows, dtype=np.int64)
+    if source_bytes is not None:
+        extra["source_bytes"] = np.asarray(source_bytes, dtype=np.int64)
+    np.savez_compressed(
+        path,
+        indptr=source_vectors.indptr,
+        indices=source_vectors.indices,
+        data=source_vectors.data,
+        shape=np.asarray(source_vectors.shape, dtype=np.int64),
+        **extra,
+    )
+
+
+def load_stats_npz(path):
+    with np.load(path) as z:
+        return CSRMatrix(z["indptr"], z["indices"], z["data"], z["shape"])
+
+
+# Per-source sizes stored next to the matrix (None when the file predates them).
+def load_source_sizes_npz(path):
+    with np.load(path) as z:
+        rows = z["source_rows"] if "source_rows" in z.files else None
+        nbytes = z["source_bytes"] if "source_bytes" in z.files else None
+    return rows, nbytes
+
+
+# Inverted index value id -> sorted source ids (i.e. the CSR matrix in column-major order).
+# sources_of(j) is a slice of one flat array, so a UR only touches the postings of its own values.
+class Postings:
+    def __init__(self, indptr, sources, n_sources):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.sources = np.asarray(sources, dtype=np.int64)
+        self.n_sources = int(n_sources)
+
+    @classmethod
+    def from_csr(cls, csr):
+        rows = np.repeat(np.arange(csr.shape[0], dtype=np.int64), np.diff(csr.indptr))
+        order = np.argsort(csr.indices, kind="stable")  # stable -> sources stay sorted per value
+        indptr = np.zeros(csr.shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(csr.indices, minlength=csr.shape[1]), out=indptr[1:])
+        return cls(indptr, rows[order], csr.shape[0])
+
+    def sources_of(self, j):
+        return self.sources[self.indptr[j]:self.indptr[j + 1]]
+
+
+def build_postings(source_vectors):
+    if not isinstance(source_vectors, CSRMatrix):
+        source_vectors = CSRMatrix.from_dense(source_vectors)
+    return Postings.from_csr(source_vectors)
+
+
+# ---- binary stats artifact (stats_bin/) ----
+# Everything load_stats needs as plain .npy files, so it can be np.load(mmap_mode="r")-ed:
+# no JSON parsing, no postings rebuild, and processes loading the same split share the pages.
+#   indptr / indices / data / shape     CSR source x value matrix
+#   post_indptr / post_sources          Postings (value id -> sources)
+#   source_rows / source_bytes          per-source sizes (optional)
+#   key_hash / key_id / key_offsets     key table sorted by 64-bit key hash, with the value id
+#   keys.bin                            utf-8 keys in key_hash order (key_offsets slices), to verify hits
+#   meta.json                           version, source_files, numeric_columns and the fingerprint of the files it came from
+# Each build is written to its own subdirectory and never modified afterwards; the one in use is
+# named by stats_bin/CURRENT, which is replaced atomically. Readers resolve CURRENT once and then
+# read only that build, so a concurrent rebuild never changes files under them.
+STATS_BIN_DIR = "stats_bin"
+STATS_BIN_VERSION = 2
+_CURRENT = "CURRENT"
+_STALE_BUILD_S = 60  # a replaced build is removed after this (readers only need it while they open it)
+_ABANDONED_BUILD_S = 3600  # unfinished builds of crashed writers
+
+
+# signed, so the hash array is int64 and searchsorted takes a plain Python int
+def _key_hash(key_bytes):
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little", signed=True)
+
+
+# Read-only "col:val" -> value id mapping over the key table; supports what the planner uses
+# from the value_index dict (get / in / []) plus len and items.
+class KeyTable:
+    def __init__(self, key_hash, key_id, key_offsets, keys_blob):
+        self.key_hash = key_hash
+        self.key_id = key_id
+        self.key_offsets = key_offsets
+        self.keys_blob = keys_blob
+
+    @classmethod
+    def build(cls, value_index):
+        encoded = [(_key_hash(k.encode()), k.encode(), int(j)) for k, j in value_index.items()]
+        encoded.sort(key=lambda e: (e[0], e[2]))
+        key_hash = np.fromiter((e[0] for e in encoded), dtype=np.int64, count=len(encoded))
+        key_id = np.fromiter((e[2] for e in encoded), dtype=np.int64, count=len(encoded))
+        key_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e[1]) for e in encoded], out=key_offsets[1:])
+        return cls(key_hash, key_id, key_offsets, b"".join(e[1] for e in encoded))
+
+    # keys_blob is bytes or an mmap.mmap: slicing either gives bytes without numpy overhead
+    def _key_at(self, i):
+        return self.keys_blob[int(self.key_offsets[i]):int(self.key_offsets[i + 1])]
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        kb = key.encode()
+        h = _key_hash(kb)
+        i = int(self.key_hash.searchsorted(h))
+        while i < len(self.key_hash) and self.key_hash[i] == h:
+            if self._key_at(i) == kb:
+                return int(self.key_id[i])
+            i += 1
+        return default
+
+    def __getitem__(self, key):
+        j = self.get(key)
+        if j is None:
+            raise KeyError(key)
+        return j
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.key_id)
+
+    def items(self):
+        for i in range(len(self.key_id)):
+            yield self._key_at(i).decode(), int(self.key_id[i])
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+
+def save_stats_bin(out_dir, source_vectors, value_index, source_files=None, source_rows=None,
+                   source_bytes=None, numeric_columns=None, fingerprint=None):
+    if not isinstance(source_vectors, CSRMatrix):
+        source_vectors = CSRMatrix.from_dense(source_vectors)
+    postings = Postings.from_csr(source_vectors)
+    keys = value_index if isinstance(value_index, KeyTable) else KeyTable.build(value_index)
+
+    os.makedirs(out_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix="build-", dir=out_dir)
+    arrays = {
+        "indptr": source_vectors.indptr,
+        "indices": source_vectors.indices,
+        "data": source_vectors.data,
+        "shape": np.asarray(source_vectors.shape, dtype=np.int64),
+        "post_indptr": postings.indptr,
+        "post_sources": postings.sources,
+        "key_hash": keys.key_hash,
+        "key_id": keys.key_id,
+        "key_offsets": keys.key_offsets,
+    }
+    if source_rows is not None:
+        arrays["source_rows"] = np.asarray(source_rows, dtype=np.int64)
+    if source_bytes is not None:
+        arrays["source_bytes"] = np.asarray(source_bytes, dtype=np.int64)
+    for name, arr in arrays.items():
+        np.save(os.path.join(build_dir, name + ".npy"), np.ascontiguousarray(arr))
+    with open(os.path.join(build_dir, "keys.bin"), "wb") as f:
+        f.write(keys.keys_blob[:])
+    meta = {
+        "version": STATS_BIN_VERSION,
+        "source_files": source_files,
+        "numeric_columns": None if numeric_columns is None else sorted(numeric_columns),
+        "fingerprint": fingerprint,
+    }
+    with open(os.path.join(build_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    # another process finished the same build first: keep its copy, drop ours (nobody has seen it)
+    current = read_stats_bin_meta(out_dir)
+    if fingerprint is not None and current is not None and current.get("fingerprint") == fingerprint:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return
+    fd, tmp = tempfile.mkstemp(prefix="CURRENT-", dir=out_dir)
+    with os.fdopen(fd, "w") as f:
+        f.write(os.path.basename(build_dir))
+    replaced = _current_build(out_dir)
+    os.replace(tmp, os.path.join(out_dir, _CURRENT))
+    if replaced:
+        os.utime(replaced)  # starts its grace period in _prune_builds
+    _prune_builds(out_dir)
+
+
+# Remove replaced builds once no reader can still be opening them, and unfinished builds left by
+# crashed writers. The current build and builds other writers are still publishing are kept.
+def _prune_builds(out_dir):
+    current = _current_build(out_dir)
+    now = time.time()
+    for name in os.listdir(out_dir):
+        path = os.path.join(out_dir, name)
+        if not os.path.isdir(path):
+            if name.endswith(".npy") or name in ("keys.bin", "meta.json"):
+                os.remove(path)  # single-directory layout of older versions
+            continue
+        if path == current:
+            continue
+        finished = os.path.exists(os.path.join(path, "meta.json"))
+        if now - os.path.getmtime(path) > (_STALE_BUILD_S if finished else _ABANDONED_BUILD_S):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# directory of the build named by CURRENT (None if there is none)
+def _current_build(bin_dir):
+    try:
+        with open(os.path.join(bin_dir, _CURRENT), "r") as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(bin_dir, name)
+    return path if name and os.path.isdir(path) else None
+
+
+def read_stats_bin_meta(bin_dir):
+    build = _current_build(bin_dir)
+    return _read_build_meta(build) if build else None
+
+
+def _read_build_meta(build):
+    try:
+        with open(os.path.join(build, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == STATS_BIN_VERSION else None
+
+
+# mmap-load the artifact (mmap_mode=None reads it into memory instead).
+def load_stats_bin(bin_dir, mmap_mode="r"):
+    build = _current_build(bin_dir)
+    meta = _read_build_meta(build) if build else None
+    if meta is None:
+        raise ValueError(f"No usable stats artifact in {bin_dir!r}")
+    bin_dir = build
+
+    # plain ndarray views of the memmaps: same pages, much cheaper scalar indexing
+    def arr(name):
+        path = os.path.join(bin_dir, name + ".npy")
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode=mmap_mode).view(np.ndarray)
+
+    shape = arr("shape")
+    vectors = CSRMatrix(arr("indptr"), arr("indices"), arr("data"), (int(shape[0]), int(shape[1])))
+    postings = Postings(arr("post_indptr"), arr("post_sources"), int(shape[0]))
+    blob_path = os.path.join(bin_dir, "keys.bin")
+    with open(blob_path, "rb") as f:
+        if mmap_mode and os.path.getsize(blob_path) > 0:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            blob = f.read()
+    keys = KeyTable(arr("key_hash"), arr("key_id"), arr("key_offsets"), blob)
+    return {
+        "value_index": keys,
+        "numeric_columns": None if meta.get("numeric_columns") is None else frozenset(meta["numeric_columns"]),
+        "source_vectors": vectors,
+        "postings": postings,
+        "source_files": meta.get("source_files"),
+        "source_rows": arr("source_rows"),
+        "source_bytes": arr("source_bytes"),
+    }
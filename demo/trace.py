@@ -0,0 +1,162 @@
+import contextvars
+import io
+import json
+import time
+
+# Lightweight tracing for the pipeline stages.
+#
+#   with Tracer() as tr:                 # activates the tracer in this context
+#       order, plan, cur = plan_ap(UR, stats)
+#   tr.spans / tr.counters / tr.events / tr.summary() / tr.to_jsonl(path)
+#
+# The instrumented code calls the module-level span() / count() / event(). With no active
+# Tracer these are a ContextVar lookup and return, so leaving the hooks in costs nothing.
+# The active tracer (and the current span) live in ContextVars: asyncio tasks started inside
+# a `with Tracer()` keep reporting to it (threads do when run in contextvars.copy_context()),
+# and concurrent requests each with their own tracer do not mix.
+
+_tracer = contextvars.ContextVar("tracer", default=None)
+_parent = contextvars.ContextVar("trace_parent", default=None)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "record", "_t0", "_token")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.record = {"id": None, "parent": None, "name": name, "start_ms": None, "duration_ms": None, "attrs": attrs}
+
+    def __enter__(self):
+        tr = self.tracer
+        self.record["id"] = tr._next_id()
+        self.record["parent"] = _parent.get()
+        self._token = _parent.set(self.record["id"])
+        self._t0 = time.perf_counter()
+        self.record["start_ms"] = (self._t0 - tr.t0) * 1e3
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["duration_ms"] = (time.perf_counter() - self._t0) * 1e3
+        if exc_type is not None:
+            self.record["attrs"]["error"] = exc_type.__name__
+        _parent.reset(self._token)
+        self.tracer.spans.append(self.record)
+        return False
+
+    # attach attributes known only at the end of the span (e.g. row counts)
+    def set(self, **attrs):
+        self.record["attrs"].update(attrs)
+
+
+class Tracer:
+    def __init__(self, name="trace", profile=False):
+        self.name = name
+        self.profile = profile
+        self.spans = []
+        self.counters = {}
+        self.events = []
+        self.profiler = None
+        self.t0 = time.perf_counter()
+        self._ids = 0
+        self._token = None
+
+    def _next_id(self):
+        self._ids += 1
+        return self._ids
+
+    def __enter__(self):
+        self._token = _tracer.set(self)
+        if self.profile:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+        _tracer.reset(self._token)
+        return False
+
+    def span(self, name, **attrs):
+        return _Span(self, name, attrs)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, name, **attrs):
+        self.events.append({"name": name, "at_ms": (time.perf_counter() - self.t0) * 1e3, "attrs": attrs})
+
+    # span name -> {"count", "total_ms"}, in first-seen order
+    def summary(self):
+        out = {}
+        for s in sorted(self.spans, key=lambda s: s["start_ms"]):
+            agg = out.setdefault(s["name"], {"count": 0, "total_ms": 0.0})
+            agg["count"] += 1
+            agg["total_ms"] += s["duration_ms"]
+        return out
+
+    # cProfile report of the traced block (profile=True only)
+    def profile_report(self, limit=25, sort="cumulative"):
+        if self.profiler is None:
+            return ""
+        import pstats
+
+        buf = io.StringIO()
+        pstats.Stats(self.profiler, stream=buf).sort_stats(sort).print_stats(limit)
+        return buf.getvalue()
+
+    def records(self):
+        for s in sorted(self.spans, key=lambda s: s["start_ms"]):
+            yield {"trace": self.name, "type": "span", **s}
+        for e in self.events:
+            yield {"trace": self.name, "type": "event", **e}
+        yield {"trace": self.name, "type": "counters", "counters": self.counters}
+
+    # One JSON object per line: spans (by start time), events, then the counters.
+    # path_or_file: a path (appended to) or an open text file.
+    def to_jsonl(self, path_or_file):
+        if hasattr(path_or_file, "write"):
+            for rec in self.records():
+                path_or_file.write(json.dumps(rec, default=str) + "\n")
+            return
+        with open(path_or_file, "a") as f:
+            self.to_jsonl(f)
+
+
+def current_tracer():
+    return _tracer.get()
+
+
+def span(name, **attrs):
+    tr = _tracer.get()
+    if tr is None:
+        return _NOOP
+    return tr.span(name, **attrs)
+
+
+def count(name, n=1):
+    tr = _tracer.get()
+    if tr is not None:
+        tr.count(name, n)
+
+
+def event(name, **attrs):
+    tr = _tracer.get()
+    if tr is not None:
+        tr.event(name, **attrs)
@@ -7,36 +7,39 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.append(PROJECT_ROOT)
 
-from demo.gen_ap import build_sql_plan, gen_ap_order,build_storeap_payload
-from demo.nl_to_ur import parse_nl_to_ur
+from demo.cache import PipelineCache
+from demo.gen_ap import build_storeap_payload
+from demo.nl_to_ur import load_compiled_lexicon, parse_nl_to_ur
+from demo.service import ServiceClient
+from demo.trace import Tracer
 import os, json
-from demo.execute_ap import execute_ap
-from demo.utils import EPrune
 LEXICON_PATH = os.path.join(PROJECT_ROOT, "demo", "lexicon.json")
-with open(LEXICON_PATH, "r") as f:
-    LEXICON = json.load(f)
 
-# Load stats data (value index and source vectors) from the given split path.
-def load_stats(split_path):
-    stats_json = os.path.join(split_path, "value_index.json")
-    stats_parquet = os.path.join(split_path, "stats.parquet")
-    source_files_json = os.path.join(split_path, "source_files.json")  # NEW
 
-    with open(stats_json, "r") as f:
-        value_index = json.load(f)
+# loaded once per server (not on every rerun of the script), on first use
+@st.cache_resource
+def get_lexicon():
+    return load_compiled_lexicon(LEXICON_PATH)
 
-    df = pd.read_parquet(stats_parquet)
-    source_vectors = df.values
 
-    source_files = None
-    if os.path.exists(source_files_json):
-        with open(source_files_json, "r") as f:
-            source_files = json.load(f)
+st.set_page_config(page_title="TVD Demo", layout="wide")
+
+SPLIT_PATH = "data/MATHE_random_100"
 
-    return {"value_index": value_index, "source_vectors": source_vectors, "source_files": source_files}
 
+# One cache per split for the whole Streamlit server: stats, plans and results survive reruns
+# and are dropped automatically when the split's files change.
+@st.cache_resource
+def get_pipeline_cache(split_path):
+    return PipelineCache(split_path)
 
-st.set_page_config(page_title="TVD Demo", layout="wide")
+
+PIPELINE = get_pipeline_cache(SPLIT_PATH)
+
+# With TVD_SERVICE_URL set (e.g. http://127.0.0.1:8765, see demo/service.py) parsing, planning,
+# execution and pruning go to the shared warm service instead of this process.
+SERVICE_URL = os.environ.get("TVD_SERVICE_URL")
+CLIENT = ServiceClient(SERVICE_URL) if SERVICE_URL else None
 
 st.title("Table Reclamation Demo 2026")
 
@@ -62,7 +65,9 @@ with col1:
     parse_button = st.button("Parse NL → UR")
 
 if parse_button and nl_query:
-    parsed_ur = parse_nl_to_ur(nl_query, LEXICON) 
+    with Tracer("Parse NL → UR") as tr:
+        parsed_ur = CLIENT.parse(nl_query) if CLIENT else parse_nl_to_ur(nl_query, get_lexicon())
+    st.session_state.setdefault("traces", {})["parse"] = tr
     
     st.session_state["UR"] = parsed_ur  # to keep the UR saved in the session. 
 
@@ -80,8 +85,6 @@ st.divider()
 # =========================
 st.header("3) Generate AP (SQL plan)")
 
-SPLIT_PATH = "data/MATHE_random_100"
-
 # ---- STEP 1: Generate AP ----
 if st.button("Generate AP"):
 
@@ -89,20 +92,27 @@ if st.button("Generate AP"):
         st.error("Parse NL → UR first.")
     else:
         UR = st.session_state["UR"]
-        stats = load_stats(SPLIT_PATH)
-        st.session_state["stats"] = stats
-
-        order = gen_ap_order(UR, stats)
-        plan = build_sql_plan(UR, order, stats)
+        with Tracer("Generate AP") as tr:
+            if CLIENT:
+                resp = CLIENT.plan(UR)
+                order, plan, missing = resp["order"], resp["sql_plan"], resp["missing"]
+            else:
+                order, plan, compiled_ur = PIPELINE.plan(UR)
+                missing = compiled_ur.missing
+        st.session_state.setdefault("traces", {})["generate"] = tr
 
         st.session_state["AP_order"] = order
         st.session_state["AP_plan"] = plan
+        st.session_state["AP_missing"] = missing
 
 # Show AP 
 if "AP_plan" in st.session_state:
 
     st.subheader("SQL Plan")
 
+    if st.session_state.get("AP_missing"):
+        st.warning("Not found in this split: " + ", ".join(f"{c}={v}" for c, v in st.session_state["AP_missing"]))
+
     for step in st.session_state["AP_plan"]:
         st.markdown(f"**{step['table']}**")
         st.code(step["sql"], language="sql")
@@ -122,11 +132,12 @@ if "AP_plan" in st.session_state:
     # ---- STEP 2: Execute AP ----
     if st.button("Execute AP"):
 
-        result_df = execute_ap(
-            st.session_state["AP_plan"],
-            split_path=SPLIT_PATH,
-            source_files=st.session_state["stats"].get("source_files")
-        )
+        with Tracer("Execute AP") as tr:
+            if CLIENT:
+                result_df = CLIENT.execute(st.session_state["AP_plan"])
+            else:
+                result_df = PIPELINE.execute(st.session_state["AP_plan"]).to_pandas()
+        st.session_state.setdefault("traces", {})["execute"] = tr
 
         st.session_state["result_df"] = result_df
 
@@ -140,10 +151,15 @@ if "result_df" in st.session_state:
     # ---- STEP 3: Prune ----
     if st.button("Prune Result"):
 
-        pruned_df = EPrune(
-            st.session_state["result_df"],
-            st.session_state["UR"]
-        )
+        with Tracer("Prune Result") as tr:
+            if CLIENT:
+                pruned_df = CLIENT.prune(st.session_state["AP_plan"], st.session_state["UR"], engine="eprune")
+            else:
+                pruned_df = PIPELINE.pruned(
+                    st.session_state["AP_plan"],
+                    st.session_state["UR"]
+                ).to_pandas()
+        st.session_state.setdefault("traces", {})["prune"] = tr
 
         st.session_state["pruned_df"] = pruned_df
 
@@ -152,4 +168,24 @@ if "result_df" in st.session_state:
 if "pruned_df" in st.session_state:
 
     st.subheader("Pruned Result")
-    st.dataframe(st.session_state["pruned_df"], use_container_width=True)
\ No newline at end of file
+    st.dataframe(st.session_state["pruned_df"], use_container_width=True)
+
+
+# =========================
+# Timings
+# =========================
+# Spans and counters of the last run of each button (a cached or remote step shows no stage spans).
+if st.session_state.get("traces"):
+    with st.expander("Timings", expanded=False):
+        for tr in st.session_state["traces"].values():
+            st.markdown(f"**{tr.name}**")
+            rows = [
+                {"span": s["name"], "ms": round(s["duration_ms"], 3), **s["attrs"]}
+                for s in sorted(tr.spans, key=lambda s: s["start_ms"])
+            ]
+            if rows:
+                st.dataframe(pd.DataFrame(rows), use_container_width=True)
+            else:
+                st.caption("served by " + SERVICE_URL if CLIENT else "served from cache")
+            if tr.counters:
+                st.json(tr.counters)
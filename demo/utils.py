@@ -1,8 +1,33 @@
+import os
+import sys
+
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.trace import count, span
+
 
-def EPrune(T, UR):
+def EPrune(T, UR, engine="numpy"):
+    """
+    engine:
+      "numpy" -> _eprune_numpy (integer-coded items, same output)
+      "loop"  -> _eprune_loop, the original per-row loop
+    """
+    if engine not in ("numpy", "loop"):
+        raise ValueError(f"Unknown EPrune engine: {engine!r}")
+    with span("prune", engine=engine, rows_in=len(T)) as sp:
+        out = _eprune_numpy(T, UR) if engine == "numpy" else _eprune_loop(T, UR)
+        sp.set(rows_out=len(out))
+        count("rows_pruned", len(T) - len(out))
+    return out
+
+
+def _eprune_loop(T, UR):
     T = T.copy()
 
     UR_sets = {col: set(vals) for col, vals in UR.items()}
@@ -50,4 +75,93 @@ def EPrune(T, UR):
     return T.drop(index=to_drop).drop(columns="_S_size")
 
 
+# ---- array version of EPrune ----
+# Each (col, value) UR item gets an integer id; rows become an (n_rows x n_cols) array of
+# item ids (-1 = no item). Rows are visited in the same _S_size order as EPrune, but:
+#   - rows without items are always dropped and never touch the counters
+#   - a run of consecutive single-item rows is solved in closed form: per item, the first
+#     count-1 rows of the run are dropped (each drop decrements the count)
+#   - only rows with 2+ items go through a sequential loop (numba-compiled if available)
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _prune_multi_rows(row_items, count, drop):
+    for r in range(row_items.shape[0]):
+        ok = True
+        for c in range(row_items.shape[1]):
+            it = row_items[r, c]
+            if it >= 0 and count[it] <= 1:
+                ok = False
+                break
+        if ok:
+            drop[r] = True
+            for c in range(row_items.shape[1]):
+                it = row_items[r, c]
+                if it >= 0:
+                    count[it] -= 1
+
+
+if njit is not None:
+    _prune_multi_rows = njit(cache=True)(_prune_multi_rows)
+
+
+def _prune_single_run(items, count):
+    # items: item id of each row of the run, in visiting order
+    order = np.argsort(items, kind="stable")
+    sorted_items = items[order]
+    starts = np.searchsorted(sorted_items, sorted_items, side="left")
+    rank = np.empty(len(items), dtype=np.int64)
+    rank[order] = np.arange(len(items)) - starts
+    drop = rank < count[items] - 1
+    np.subtract.at(count, items[drop], 1)
+    return drop
+
+
+def _eprune_numpy(T, UR):
+    UR_sets = {col: set(vals) for col, vals in UR.items()}
+    cols = [col for col in UR_sets.keys() if col in T.columns]
+    if not cols or T.empty:
+        return T.copy()
+
+    n = len(T)
+    row_items = np.full((n, len(cols)), -1, dtype=np.int64)
+    s_size = np.zeros(n, dtype=np.int64)
+    n_ids = 0
+    for c, col in enumerate(cols):
+        series = T[col]
+        mask = series.isin(UR_sets[col]).to_numpy()
+        s_size += mask
+        mask = mask & series.notna().to_numpy()
+        codes, uniques = pd.factorize(series[mask])
+        row_items[mask, c] = codes + n_ids
+        n_ids += len(uniques)
+
+    count = np.bincount(row_items[row_items >= 0], minlength=n_ids).astype(np.int64)
+    n_items = (row_items >= 0).sum(axis=1)
+
+    # same visiting order as EPrune: stable sort on _S_size; item-less rows are dropped outright
+    visit = np.argsort(s_size, kind="stable")
+    visit = visit[n_items[visit] > 0]
+    drop = np.ones(n, dtype=bool)
+    drop[visit] = False
+
+    single = n_items[visit] == 1
+    # boundaries between runs of single-item / multi-item rows
+    cuts = np.flatnonzero(np.diff(single.astype(np.int8))) + 1
+    for run in np.split(np.arange(len(visit)), cuts):
+        if len(run) == 0:
+            continue
+        rows = visit[run]
+        if single[run[0]]:
+            items = row_items[rows].max(axis=1)
+            drop[rows] = _prune_single_run(items, count)
+        else:
+            run_drop = np.zeros(len(rows), dtype=np.bool_)
+            _prune_multi_rows(row_items[rows], count, run_drop)
+            drop[rows] = run_drop
+
+    return T.iloc[~drop].copy()
 
@@ -0,0 +1,81 @@
+import math
+import re
+
+import numpy as np
+
+# Canonical encoding of cell / UR values for the value index.
+# Every value is mapped to one string so that 80, 80.0 and numpy.int64(80) end up on the
+# same "col:80" key, and the planner needs a single dict lookup.
+#   ints and integral floats -> "80"
+#   other floats             -> repr, e.g. "0.5"
+#   bools                    -> "True" / "False"
+#   strings                  -> unchanged, unless numeric=True (the column is numeric):
+#                               then a numeric string is the number it spells ("26.0" -> "26")
+#   None / NaN               -> None (not indexed)
+# Text columns that hold codes ("007", "1e5") keep every spelling as a distinct value.
+
+_INT_RE = re.compile(r"[+-]?\d+")
+_FLOAT_RE = re.compile(r"[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?")
+
+
+def _canon_float(f):
+    if math.isnan(f):
+        return None
+    if math.isfinite(f) and f.is_integer():
+        return str(int(f))
+    return repr(f)
+
+
+def canon_value(v, numeric=False):
+    if v is None:
+        return None
+    if isinstance(v, (bool, np.bool_)):
+        return str(bool(v))
+    if isinstance(v, (int, np.integer)):
+        return str(int(v))
+    if isinstance(v, (float, np.floating)):
+        return _canon_float(float(v))
+    if isinstance(v, str):
+        if numeric:
+            if _INT_RE.fullmatch(v):
+                return str(int(v))
+            if _FLOAT_RE.fullmatch(v):
+                return _canon_float(float(v))
+        return v
+    return canon_value(str(v), numeric)
+
+
+def canon_key(col, v, numeric=False):
+    cv = canon_value(v, numeric)
+    if cv is None:
+        return None
+    return f"{col}:{cv}"
+
+
+def _is_number(val):
+    return bool(_FLOAT_RE.fullmatch(val)) or val in ("inf", "-inf")
+
+
+# Columns whose indexed values are all numbers, from "col:val" keys. A CSV column is read as
+# numbers only when every cell parses as one, so these are the columns of numeric dtype.
+def numeric_columns(keys):
+    seen, text = set(), set()
+    for key in keys:
+        col, _, val = key.partition(":")
+        seen.add(col)
+        if col not in text and not _is_number(val):
+            text.add(col)
+    return frozenset(seen - text)
+
+
+# Re-encode a value_index.json written before canonical keys ("id_subtopic:26.0" -> "id_subtopic:26").
+# Only numeric columns are re-encoded; keys of text columns are kept as written.
+def canonicalize_value_index(value_index):
+    numeric = numeric_columns(value_index)
+    out = {}
+    for key, j in value_index.items():
+        col, _, val = key.partition(":")
+        ck = canon_key(col, val, col in numeric)
+        if ck is not None:
+            out.setdefault(ck, j)
+    return out
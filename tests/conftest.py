@@ -0,0 +1,76 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from demo.gen_ap import load_stats, plan_ap
+from demo.generate_stats import generate_stats_from_folder
+
+BUNDLED_SPLIT = os.path.join(PROJECT_ROOT, "data", "MATHE_random_100")
+CORPUS_PATH = os.path.join(PROJECT_ROOT, "data", "generated_aps", "ap_corpus", "ap_corpus.jsonl")
+
+# URs the corpus does not exercise: values of the wrong type for their column, numbers spelled
+# as strings, values that are not in the split at all.
+EDGE_URS = [
+    {"topic_name": ["Linear Algebra"], "newLevel": [2, "high"]},
+    {"topic_name": ["Linear Algebra"], "newLevel": ["2", "3"]},
+    {"question_id": [750, "750", 99999999], "keyword_name": ["Path", "No such keyword"]},
+    {"id_topic": [18.0], "subtopic_name": ["Recursivity"]},
+    {"keyword_name": ["No such keyword"]},
+]
+
+
+# Result rows as a sorted list, independent of row and column order; missing values compare equal.
+def rows(df):
+    if not isinstance(df, pd.DataFrame):
+        df = df.to_pandas()
+    df = df[sorted(df.columns)]
+    return sorted(
+        tuple("" if pd.isna(v) else f"={v}" for v in row)
+        for row in df.itertuples(index=False, name=None)
+    )
+
+
+# A copy of the bundled split (CSVs only) with freshly built stats; the tests may write
+# split.duckdb / stats_bin next to it without touching data/.
+@pytest.fixture(scope="session")
+def split_path(tmp_path_factory):
+    path = os.path.join(str(tmp_path_factory.mktemp("split")), "MATHE_random_100")
+    os.makedirs(path)
+    for fname in os.listdir(BUNDLED_SPLIT):
+        if fname.endswith(".csv"):
+            shutil.copy2(os.path.join(BUNDLED_SPLIT, fname), path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate_stats_from_folder(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def stats(split_path):
+    return load_stats(split_path)
+
+
+@pytest.fixture(scope="session")
+def corpus():
+    with open(CORPUS_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.fixture(scope="session")
+def urs(corpus):
+    return [rec["ur"] for rec in corpus] + EDGE_URS
+
+
+# (UR, plan) for every UR, planned against the split's stats (tables named after source_files)
+@pytest.fixture(scope="session")
+def plans(urs, stats):
+    return [(UR, plan_ap(UR, stats)[1]) for UR in urs]
@@ -0,0 +1,48 @@
+import io
+import json
+
+from conftest import EDGE_URS
+from demo.batch import run_batch, split_name
+from demo.execute_ap import execute_ap
+
+
+def _run(queries, split_path, **kwargs):
+    out = io.StringIO()
+    n = run_batch(iter(queries), out, split_path, **kwargs)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert n == len(records) == len(queries)
+    return records
+
+
+def test_split_name():
+    assert split_name("data/MATHE_random_100") == "random_100"
+    assert split_name("data/generated_splits/MATHE/random_100/") == "random_100"
+    assert split_name("data/other_split", dataset="MATHE") == "other_split"
+
+
+def test_records_match_the_corpus_shape(split_path, stats, corpus):
+    queries = [{"id": i, "ur": rec["ur"]} for i, rec in enumerate(corpus)] + [{"ur": UR} for UR in EDGE_URS]
+    records = _run(queries, split_path)
+    names = set(stats["source_files"])
+    for q, rec in zip(queries, records):
+        ap = rec["ap"]
+        assert rec["ur"] == q["ur"] and rec.get("id") == q.get("id")
+        assert ap["meta"]["split"] == corpus[0]["ap"]["meta"]["split"] == "random_100"
+        assert ap["meta"]["ap_len"] == len(ap["source_order"])
+        # source_order names the plan's tables, in order
+        assert set(ap["source_order"]) <= names
+        tables = [step["table"] for step in ap["sql_plan"]]
+        assert tables == [t for t in ap["source_order"] if t in tables]
+    missing = records[len(corpus)]["ap"]["missing"]
+    assert ["newLevel", "high"] in missing
+
+
+def test_execute_row_counts(split_path, stats, corpus):
+    queries = [{"ur": rec["ur"]} for rec in corpus[:40]] + [{"ur": UR} for UR in EDGE_URS]
+    for kwargs in ({}, {"execute_chunk": 7}, {"use_db": False}):
+        scan_stats = {}
+        records = _run(queries, split_path, execute=True, scan_stats=scan_stats, **kwargs)
+        for rec in records:
+            plan = rec["ap"]["sql_plan"]
+            assert rec["rows"] == len(execute_ap(plan, split_path, stats["source_files"])), rec["ur"]
+        assert scan_stats["steps"] == sum(len(r["ap"]["sql_plan"]) for r in records)
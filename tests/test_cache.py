@@ -0,0 +1,86 @@
+import contextlib
+import io
+import os
+import shutil
+import threading
+
+import pytest
+
+from conftest import BUNDLED_SPLIT, rows
+from demo.cache import LRUCache, PipelineCache, split_fingerprint, ur_key
+from demo.execute_ap import execute_ap
+from demo.generate_stats import generate_stats_from_folder
+from demo.utils import EPrune
+
+
+@pytest.fixture
+def cache(split_path):
+    return PipelineCache(split_path)
+
+
+def test_pruned_matches_eprune(cache, split_path, stats, plans):
+    for UR, plan in plans[::5]:
+        expected = EPrune(execute_ap(plan, split_path, stats["source_files"]), UR)
+        assert rows(cache.pruned(plan, UR)) == rows(expected), UR
+
+
+def test_pruned_hit_skips_execute(cache, plans, monkeypatch):
+    UR, plan = plans[0]
+    first = cache.pruned(plan, UR)
+    monkeypatch.setattr(cache, "execute", lambda *a, **k: pytest.fail("executed on a pruned hit"))
+    assert cache.pruned(plan, UR) is first
+
+
+def test_exec_and_pruned_keys_do_not_collide(cache, plans):
+    _, plan = plans[0]
+    executed = cache.execute(plan)
+    assert ur_key({}) == "{}"
+    cache.pruned(plan, {})
+    assert len(cache.results) == 2
+    assert cache.execute(plan) is executed
+
+
+def test_plan_keys_are_exact(cache):
+    a = cache.plan({"id_topic": [18]})
+    b = cache.plan({"id_topic": ["18"]})
+    assert a[1] != b[1]
+    assert cache.plan({"id_topic": [18]}) is a
+
+
+def test_lru_is_thread_safe():
+    lru = LRUCache(max_entries=50, max_bytes=10_000)
+    errors = []
+
+    def work(t):
+        try:
+            for i in range(2000):
+                lru.put((t, i % 80), b"x" * (i % 300))
+                lru.get((t, (i * 7) % 80))
+        except Exception as e:  # OrderedDict mutated during move_to_end / popitem
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert not errors
+    assert len(lru) <= 50 and lru.nbytes <= 10_000
+    assert lru.nbytes == sum(size for _, size in lru._data.values())
+
+
+def test_fingerprint_check_is_throttled(tmp_path):
+    for fname in ("src_1.csv", "src_2.csv"):
+        shutil.copy2(os.path.join(BUNDLED_SPLIT, fname), tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate_stats_from_folder(str(tmp_path))
+    split = str(tmp_path)
+
+    lazy = PipelineCache(split, check_interval=3600)
+    eager = PipelineCache(split, check_interval=0)
+    lazy.stats_data(), eager.stats_data()
+    fp = split_fingerprint(split)
+    os.utime(os.path.join(split, "src_1.csv"), ns=(0, 0))
+    lazy.stats_data(), eager.stats_data()
+    assert lazy._fingerprint == fp
+    assert eager._fingerprint == split_fingerprint(split) != fp
@@ -0,0 +1,90 @@
+import os
+import shutil
+
+import duckdb
+import pandas as pd
+import pytest
+
+from conftest import BUNDLED_SPLIT, rows
+from demo import execute_ap as ex
+from demo.execute_ap import execute_ap, ingest_split, open_split_connection
+
+
+# a writable split of a few CSVs, for tests that change files
+@pytest.fixture
+def small_split(tmp_path):
+    for fname in ("src_1.csv", "src_2.csv", "src_3.csv"):
+        shutil.copy2(os.path.join(BUNDLED_SPLIT, fname), tmp_path)
+    return str(tmp_path)
+
+
+def _count(split_path, table, **kwargs):
+    plan = [{"table": table, "sql": f"SELECT * FROM {table}"}]
+    return len(execute_ap(plan, split_path, source_files=[table], **kwargs))
+
+
+def _drop_last_row(path):
+    df = pd.read_csv(path)
+    df.iloc[:-1].to_csv(path, index=False)
+
+
+def test_db_and_csv_return_the_same_rows(split_path, stats, plans):
+    sf = stats["source_files"]
+    with open_split_connection(split_path, sf) as db, open_split_connection(split_path, sf, use_db=False) as csv:
+        for UR, plan in plans:
+            assert rows(execute_ap(plan, split_path, sf, con=db)) == \
+                rows(execute_ap(plan, split_path, sf, con=csv)), UR
+
+
+def test_ingest_is_reused_until_a_csv_changes(small_split):
+    db = ingest_split(small_split)
+    assert ingest_split(small_split) == db
+    n = _count(small_split, "src_2")
+
+    _drop_last_row(os.path.join(small_split, "src_2.csv"))
+    db2 = ingest_split(small_split)
+    assert db2 != db and os.path.exists(db2)
+    assert _count(small_split, "src_2") == n - 1
+
+    os.remove(os.path.join(small_split, "src_3.csv"))
+    with duckdb.connect(ingest_split(small_split), read_only=True) as con:
+        assert {t for (t,) in con.execute("SHOW TABLES").fetchall()} == {"src_1", "src_2"}
+
+
+def test_connection_survives_a_reingest(small_split):
+    with open_split_connection(small_split, ["src_1"]) as con:
+        n = len(con.execute("SELECT * FROM src_1").fetchall())
+        _drop_last_row(os.path.join(small_split, "src_1.csv"))
+        assert _count(small_split, "src_1") == n - 1
+        assert len(con.execute("SELECT * FROM src_1").fetchall()) == n
+
+
+def test_busy_lock_falls_back(small_split, monkeypatch):
+    fcntl = pytest.importorskip("fcntl")
+    db = ingest_split(small_split)
+    n = _count(small_split, "src_1")
+    with open(os.path.join(small_split, "split_ingest.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # up to date: the current generation, without waiting for the lock
+        assert ingest_split(small_split) == db
+        # stale: nothing to attach, the plan reads the CSVs
+        _drop_last_row(os.path.join(small_split, "src_1.csv"))
+        assert ingest_split(small_split, lock_timeout=0.1) is None
+        monkeypatch.setattr(ex, "_INGEST_LOCK_TIMEOUT_S", 0.1)
+        assert _count(small_split, "src_1") == n - 1
+        # other files are still served from the current generation
+        assert ingest_split(small_split, files=["src_2.csv"], lock_timeout=0.1) == db
+
+
+def test_read_only_split_falls_back_to_csv(small_split, monkeypatch):
+    n = _count(small_split, "src_1", use_db=False)
+    real_open = open
+
+    def read_only(path, *args, **kwargs):
+        if str(path).startswith(small_split) and args and args[0] != "r":
+            raise PermissionError(path)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", read_only)
+    assert ingest_split(small_split) is None
+    assert _count(small_split, "src_1") == n
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from demo.gen_ap import (
+    _get_numeric_columns,
+    _lookup_value,
+    compile_ur,
+    gen_ap_order,
+    gen_ap_order_lazy,
+    load_stats,
+)
+
+
+# The original dense scan: every round, every unused source, gain = alive items it holds;
+# the first source with the largest gain wins.
+def baseline_order(UR, stats):
+    cur = compile_ur(UR, stats)
+    numeric = _get_numeric_columns(stats)
+    ids = [_lookup_value(stats["value_index"], col, v, numeric) for col, v in cur.items]
+    dense = stats["source_vectors"].toarray()
+    alive = set(range(len(ids)))
+    order = []
+    while alive:
+        gains = [sum(1 for k in alive if dense[src, ids[k]] > 0) if src not in order else 0
+                 for src in range(dense.shape[0])]
+        best = int(np.argmax(gains))
+        if gains[best] == 0:
+            break
+        order.append(best)
+        alive -= {k for k in alive if dense[best, ids[k]] > 0}
+    return order
+
+
+def test_bincount_order_matches_baseline(urs, stats):
+    for UR in urs:
+        assert gen_ap_order(UR, stats) == baseline_order(UR, stats), UR
+
+
+def test_lazy_unit_order_matches_baseline(urs, stats):
+    for UR in urs:
+        assert gen_ap_order_lazy(UR, stats, "unit") == baseline_order(UR, stats), UR
+
+
+@pytest.mark.parametrize("cost_model", ["rows", "bytes"])
+def test_lazy_cost_models_cover_every_item(urs, stats, cost_model):
+    for UR in urs:
+        cur = compile_ur(UR, stats)
+        order = gen_ap_order_lazy(cur, stats, cost_model)
+        assert len(set(order)) == len(order)
+        covered = {k for src in order for k in cur.coverage.get(src, [])}
+        assert covered == set(range(len(cur.items))), UR
+
+
+def test_missing_values_are_reported_not_ordered(stats):
+    cur = compile_ur({"newLevel": [2, "high"], "keyword_name": ["No such keyword"]}, stats)
+    assert ("newLevel", "high") in cur.missing
+    assert ("keyword_name", "No such keyword") in cur.missing
+    assert [col for col, _ in cur.items] == ["newLevel"]
+
+
+def test_binary_artifact_gives_the_same_order(urs, split_path, stats):
+    from_files = load_stats(split_path, use_bin=False)
+    for UR in urs:
+        assert gen_ap_order(UR, stats) == gen_ap_order(UR, from_files), UR
+
+
+def test_unknown_cost_model(stats):
+    with pytest.raises(ValueError):
+        gen_ap_order_lazy({"newLevel": [2]}, stats, "nope")
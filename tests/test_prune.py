@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from conftest import rows
+from demo.execute_ap import execute_ap_pruned, open_split_connection
+from demo.utils import EPrune
+
+
+# The plan's rows in the order execute_ap_pruned numbers them: step by step, first occurrence kept.
+def _plan_rows(con, plan):
+    dfs = [con.execute(step["sql"]).fetchdf() for step in plan]
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True).drop_duplicates().reset_index(drop=True)
+
+
+@pytest.fixture(scope="module")
+def con(split_path, stats):
+    con = open_split_connection(split_path, stats["source_files"])
+    yield con
+    con.close()
+
+
+def test_numpy_engine_matches_loop(con, plans):
+    for UR, plan in plans:
+        T = _plan_rows(con, plan)
+        assert EPrune(T, UR, engine="numpy").equals(EPrune(T, UR, engine="loop")), UR
+
+
+def test_duckdb_prune_matches_eprune(con, split_path, stats, plans):
+    for UR, plan in plans:
+        expected = EPrune(_plan_rows(con, plan), UR)
+        got = execute_ap_pruned(plan, UR, split_path, stats["source_files"], con=con)
+        assert rows(got) == rows(expected), UR
+
+
+# values of the wrong type never match, like pandas isin: no error, no extra coverage
+@pytest.mark.parametrize("UR", [
+    {"topic_name": ["Linear Algebra"], "newLevel": [2, "high"]},
+    {"topic_name": ["Linear Algebra"], "newLevel": ["2", "3"]},
+    {"topic_name": ["Linear Algebra"], "newLevel": [2.0, None, float("nan"), True]},
+    {"topic_name": ["Linear Algebra", 7], "id_topic": ["18", 18]},
+])
+def test_mixed_type_values(con, split_path, stats, UR):
+    plan = [{"table": t, "sql": f"SELECT topic_name, newLevel, id_topic FROM {t}"}
+            for t in stats["source_files"][:5]]
+    expected = EPrune(_plan_rows(con, plan), UR)
+    assert rows(execute_ap_pruned(plan, UR, split_path, stats["source_files"], con=con)) == rows(expected)
+    assert rows(EPrune(_plan_rows(con, plan), UR, engine="loop")) == rows(expected)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        EPrune(pd.DataFrame({"a": [1]}), {"a": [1]}, engine="nope")
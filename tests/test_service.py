@@ -0,0 +1,83 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from conftest import BUNDLED_SPLIT
+from demo.service import PipelineService
+
+UR = {"topic_name": ["Linear Algebra", 7], "newLevel": [2, "high"]}
+
+
+@pytest.fixture
+def service(tmp_path):
+    from demo.generate_stats import generate_stats_from_folder
+
+    split = tmp_path / "MATHE_random_100"
+    split.mkdir()
+    for fname in ("src_1.csv", "src_2.csv", "src_3.csv"):
+        shutil.copy2(os.path.join(BUNDLED_SPLIT, fname), split)
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate_stats_from_folder(str(split))
+    s = PipelineService(str(split), workers=2)
+    s.cache.check_interval = 0  # see every file change at once
+    yield s
+    s.close()
+
+
+def _post(s, path, body):
+    return asyncio.run(s.dispatch("POST", path, json.dumps(body).encode()))
+
+
+def test_split_change_with_a_request_in_flight(service):
+    plan = service.plan({"ur": UR})["sql_plan"]
+    first = service.execute({"plan": plan})
+    csv = os.path.join(service.split_path, "src_1.csv")
+    with service._connection() as (con, _, _):
+        held = service._con
+        df = pd.read_csv(csv)
+        df.iloc[:-1].to_csv(csv, index=False)
+        # re-ingests into a new generation while the held connection is attached to the old one
+        second = service.execute({"plan": plan, "mode": "union"})
+        assert service._con is not held and held[3]
+        assert con.execute("SELECT count(*) FROM src_1").fetchone()[0] == len(df)
+        assert second["n_rows"] <= first["n_rows"]
+    with pytest.raises(Exception):
+        con.execute("SELECT 1")  # closed by its last user
+    with service._connection() as (con, _, _):
+        assert con.execute("SELECT count(*) FROM src_1").fetchone()[0] == len(df) - 1
+
+
+@pytest.mark.parametrize("path,body", [
+    ("/plan", {"ur": {"topic_name": "Discrete Mathematics"}}),
+    ("/execute", {"ur": {"topic_name": "Discrete Mathematics"}}),
+    ("/prune", {"ur": {"topic_name": "Discrete Mathematics"}}),
+    ("/prune", {"ur": ["topic_name"]}),
+    ("/prune", {"ur": {"topic_name": [["Linear Algebra"]]}}),
+    ("/execute", {"plan": "SELECT * FROM src_1"}),
+    ("/prune", {"ur": UR, "plan": [{"table": "src_1"}]}),
+])
+def test_invalid_bodies_are_rejected(service, path, body):
+    status, payload = _post(service, path, body)
+    assert status == 400, payload
+
+
+def test_plan_source_order_names_the_plan_tables(service):
+    status, out = _post(service, "/plan", {"ur": UR})
+    assert status == 200
+    assert out["source_order"] and set(out["source_order"]) <= {"src_1", "src_2", "src_3"}
+    assert [step["table"] for step in out["sql_plan"]] == out["source_order"][:len(out["sql_plan"])]
+    assert ["newLevel", "high"] in out["missing"]
+
+
+def test_prune_engines_agree_on_mixed_types(service):
+    for ur in (UR, {"topic_name": ["Linear Algebra"], "newLevel": ["2", "3"]}):
+        status, duck = _post(service, "/prune", {"ur": ur})
+        status2, eprune = _post(service, "/prune", {"ur": ur, "engine": "eprune"})
+        assert status == status2 == 200
+        assert sorted(map(json.dumps, duck["data"])) == sorted(map(json.dumps, eprune["data"]))
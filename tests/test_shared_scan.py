@@ -0,0 +1,56 @@
+import re
+
+import pytest
+
+from conftest import rows
+from demo.execute_ap import _split_step_sql, execute_ap, execute_batch, open_split_connection
+from demo.gen_ap import plan_ap
+
+
+@pytest.fixture(scope="module")
+def con(split_path, stats):
+    con = open_split_connection(split_path, stats["source_files"])
+    yield con
+    con.close()
+
+
+# URs on question texts that contain SQL keywords ("... from a group of 7 women ...")
+@pytest.fixture(scope="module")
+def keyword_urs(stats):
+    words = re.compile(r"\b(order|group|limit|union)\b", re.IGNORECASE)
+    texts = [k.split(":", 1)[1] for k, _ in stats["value_index"].items()
+             if k.startswith("question:") and words.search(k)]
+    assert texts
+    return [{"question": texts[i:i + 3], "newLevel": [2, "2"]} for i in range(0, min(len(texts), 30), 3)]
+
+
+def _check_batch(con, split_path, stats, urs):
+    plans = [plan_ap(UR, stats)[1] for UR in urs]
+    sf = stats["source_files"]
+    stats_shared, stats_unshared = {}, {}
+    shared = execute_batch(plans, split_path, sf, scan_stats=stats_shared, con=con)
+    unshared = execute_batch(plans, split_path, sf, shared=False, scan_stats=stats_unshared, con=con)
+    for UR, plan, a, b in zip(urs, plans, shared, unshared):
+        expected = rows(execute_ap(plan, split_path, sf, con=con))
+        assert rows(a) == expected, UR
+        assert rows(b) == expected, UR
+    assert stats_unshared["scans"] == stats_unshared["steps"] == stats_shared["steps"]
+    return stats_shared
+
+
+def test_shared_scan_matches_per_plan_execution(con, split_path, stats, urs):
+    scan_stats = _check_batch(con, split_path, stats, urs)
+    assert scan_stats["scans"] < scan_stats["steps"]
+
+
+def test_keywords_inside_literals_still_merge(con, split_path, stats, keyword_urs):
+    scan_stats = _check_batch(con, split_path, stats, keyword_urs)
+    assert scan_stats["unshared"] == 0
+
+
+def test_split_step_sql():
+    sql = "SELECT DISTINCT topic_name FROM src_1 WHERE topic_name IN ('Order of operations', 'It''s a GROUP')"
+    assert _split_step_sql(sql) == (True, ["topic_name"], "src_1", "topic_name IN ('Order of operations', 'It''s a GROUP')")
+    assert _split_step_sql('SELECT * FROM src_1 WHERE "limit" = 1') is not None
+    assert _split_step_sql("SELECT * FROM src_1 WHERE a = 'x' ORDER BY a") is None
+    assert _split_step_sql("SELECT * FROM src_1 WHERE a = 'x' UNION SELECT * FROM src_2 WHERE a = 'y'") is None
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from conftest import EDGE_URS, rows
+from demo.execute_ap import PruneStream, execute_ap, open_split_connection
+
+
+# (col, value) UR items the rows cover, values compared as text like rows()
+def _covered(df, UR):
+    items = set()
+    for col, vals in UR.items():
+        if col in df.columns:
+            hit = df[col][df[col].isin(vals) & df[col].notna()]
+            items.update((col, f"={v}") for v in hit)
+    return items
+
+
+@pytest.fixture(scope="module")
+def corpus_plans(corpus):
+    # SELECT * plans: the steps' schemas differ between sources
+    return [(rec["ur"], rec["ap"]["sql_plan"]) for rec in corpus]
+
+
+def test_stream_covers_what_the_union_covers(split_path, stats, plans):
+    sf = stats["source_files"]
+    with open_split_connection(split_path, sf) as con:
+        for UR, plan in plans:
+            union = execute_ap(plan, split_path, sf, mode="union", con=con)
+            stream = PruneStream(plan, UR, split_path, sf)
+            kept = stream.to_pandas()
+            assert len(kept) == stream.rows_out <= len(union), UR
+            assert _covered(kept, UR) == _covered(union, UR), UR
+            cols = [c for c in UR if c in union.columns]
+            assert set(rows(kept[cols])) <= set(rows(union[cols])), UR
+
+
+def test_to_pandas_on_mixed_schemas(split_path, corpus_plans):
+    n_mixed = 0
+    for UR, plan in corpus_plans:
+        stream = PruneStream(plan, UR, split_path)
+        batches = list(stream)
+        if len({b.schema for b in batches}) > 1:
+            n_mixed += 1
+            df = PruneStream(plan, UR, split_path).to_pandas()
+            assert len(df) == sum(b.num_rows for b in batches)
+            assert set(df.columns) == {name for b in batches for name in b.schema.names}
+    assert n_mixed > 0
+
+
+@pytest.mark.parametrize("UR", EDGE_URS)
+def test_mixed_and_missing_values(split_path, stats, UR):
+    plan = [{"table": t, "sql": f"SELECT * FROM {t}"} for t in stats["source_files"][:10]]
+    union = execute_ap(plan, split_path, stats["source_files"], mode="union")
+    stream = PruneStream(plan, UR, split_path, stats["source_files"])
+    kept = stream.to_pandas()
+    assert _covered(kept, UR) == _covered(union, UR)
+    assert stream.rows_in >= len(union) and stream.peak_bytes > 0
+
+
+def test_empty_plan(split_path):
+    assert PruneStream([], {"newLevel": [2]}, split_path).to_pandas().equals(pd.DataFrame())